@@ -1,3 +1,5 @@
+import os
+
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from dotenv import load_dotenv
@@ -10,10 +12,15 @@ load_dotenv()
 db = SQLAlchemy()
 
 
-def create_app():
+def create_app(init_schema=True):
+    """
+    Tworzy aplikację Flask. Z init_schema=False schemat nie jest
+    przygotowywany tutaj - trzeba wywołać prepare_schema(app) później
+    (np. w tle, żeby serwer HTTP wystartował od razu)
+    """
     app = Flask(__name__)
 
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///weather.db'
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///weather.db')
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False 
 
     CORS(app)
@@ -24,7 +31,20 @@ def create_app():
 
     app.register_blueprint(api_bp, url_prefix='/api')
 
-    with app.app_context():
-        db.create_all()
+    from app.profiling import ProfilerManager
+    app.extensions['profiler'] = ProfilerManager(app)
+
+    app.extensions['schema_ready'] = False
+    if init_schema:
+        prepare_schema(app)
+
+    return app
 
-    return app
\ No newline at end of file
+
+def prepare_schema(app):
+    """Idempotentnie przygotowuje schemat i oznacza aplikację jako gotową"""
+    from app.schema import ensure_schema
+
+    with app.app_context():
+        ensure_schema()
+    app.extensions['schema_ready'] = True
\ No newline at end of file
@@ -3,140 +3,309 @@ Alert Engine
 Sprawdza warunki pogodowe i generuje alerty
     względem zdefiniowanych reguł
 
+Alert to epizod: jeden wiersz na regułę i miasto, aktualizowany w miejscu
+(szczyt, last_seen, liczba wyzwoleń) dopóki warunek trwa i zamykany,
+gdy warunek przestaje być spełniony
+
 """
 
 from app import db
-from app.models import Alert, AlertRule, WeatherReading
+from app.models import Alert, AlertRule
+from app.rule_index import ANOMALY_OPERATOR, CompiledRule, rule_cache
 from datetime import datetime, timedelta
+from sqlalchemy import bindparam, func, insert, select, update
+
+
+# Kolejność ważności - epizod może tylko podnieść swój poziom
+SEVERITY_RANK = {'info': 0, 'warning': 1, 'critical': 2}
+
+
+class Episode:
+    """Stan otwartego epizodu alertu trzymany w pamięci silnika"""
+
+    __slots__ = ('alert_id', 'rule_id', 'kind', 'peak_score', 'severity', 'closed_at', 'alert')
+
+    def __init__(self, alert_id, rule_id, kind, peak_score, severity, alert=None):
+        self.alert_id = alert_id
+        self.rule_id = rule_id
+        self.kind = kind              # 'threshold' albo 'anomaly'
+        self.peak_score = peak_score  # im większy, tym bardziej skrajna wartość
+        self.severity = severity
+        self.closed_at = None
+        self.alert = alert            # nowy Alert przed zapisem (alert_id jeszcze None)
+
+
+def peak_score(operator: str, value: float) -> float:
+    """Miara "skrajności" wartości dla reguły progowej"""
+    if operator in ('>', '>='):
+        return value
+    if operator in ('<', '<='):
+        return -value
+    return 0.0
 
 
 class AlertEngine:
-    """Silnik alertów - sprawdza reguły i generuje alerty"""
+    """Silnik alertów - sprawdza reguły i prowadzi epizody alertów"""
     
-    def __init__(self):
-        self.operators = {
-            '>': lambda a, b: a > b,
-            '<': lambda a, b: a < b,
-            '>=': lambda a, b: a >= b,
-            '<=': lambda a, b: a <= b,
-            '==': lambda a, b: a == b
-        }
+    def __init__(self, reopen_minutes: int = 30, live: bool = True):
+        # Epizod zamknięty krócej niż reopen_window temu jest wznawiany
+        # zamiast tworzenia nowego (żeby nie spamować alertami przy wahaniach)
+        self.reopen_window = timedelta(minutes=reopen_minutes)
+        # live=False: epizody tylko z tej instancji (import historii) -
+        # otwarte epizody z bazy nie są wczytywane ani zamykane
+        self.live = live
+        self.rules = rule_cache
+        self.open_episodes = {}       # miasto -> {rule_id: Episode}
+        self.recently_closed = {}     # rule_id -> (miasto, Episode)
+        self._episodes_loaded = False
+        self._new_episodes = []       # epizody z alertem czekającym na zapis
+        self._changes = []            # zmiany zapisanych epizodów w kolejności zdarzeń
     
-    def check_reading(self, reading: WeatherReading):
+    def check_reading(self, reading, now: datetime = None, commit: bool = True):
         """
         Sprawdza odczyt pogodowy względem wszystkich aktywnych reguł
-        i generuje alerty jeśli warunki są spełnione
+        i otwiera, aktualizuje lub zamyka epizody alertów.
+        Zwraca nowo otwarte alerty. `now` pozwala ocenić odczyt historyczny
+        z jego własnym czasem (import danych archiwalnych), commit=False
+        odkłada zapis do flush_episodes() (patrz apply_episodes).
         """
-        rules = AlertRule.query.filter_by(
-            city=reading.city,
-            is_active=True
-        ).all()
+        # Skompilowane reguły miasta - bisekcja po progach każdej metryki
+        crossed = self.rules.get(reading.city).crossed(reading)
         
-        generated_alerts = []
-        # Sprawdź każdą regułę pod kątem odczytu pogodowego
-        for rule in rules:
-            if self._should_trigger_alert(reading, rule):
-                alert = self._create_alert(reading, rule)
-                if alert:
-                    generated_alerts.append(alert) # Dodaj wygenerowany alert do listy
+        triggered = [
+            (rule, value, None, None, peak_score(rule.operator, value))
+            for rule, value in crossed
+        ]
+        return self.apply_episodes(reading, triggered, kind='threshold', now=now, commit=commit)
+    
+    def load_open_episodes(self):
+        """Wczytuje otwarte epizody z bazy (przy starcie lub po rozjechaniu stanu)"""
+        self._new_episodes = []
+        self._changes = []
+        if not self.live:
+            # Usunięte lub wycofane epizody importu - zaczynamy od pustego stanu
+            self.open_episodes = {}
+            self.recently_closed = {}
+            self._episodes_loaded = True
+            return
         
-        return generated_alerts
+        rows = db.session.execute(
+            select(Alert.id, Alert.rule_id, Alert.city, Alert.peak_value,
+                   Alert.severity, AlertRule.operator)
+            .join(AlertRule, AlertRule.id == Alert.rule_id)
+            .where(Alert.closed_at.is_(None))
+        )
+        
+        self.open_episodes = {}
+        self.recently_closed = {}
+        for alert_id, rule_id, city, peak_value, severity, operator in rows:
+            if operator == ANOMALY_OPERATOR:
+                # z-score szczytu nie jest zapisywany - zostaw zapisany szczyt
+                kind, score = 'anomaly', float('inf')
+            else:
+                kind, score = 'threshold', peak_score(operator, peak_value)
+            self.open_episodes.setdefault(city, {})[rule_id] = Episode(
+                alert_id, rule_id, kind, score, severity)
+        self._episodes_loaded = True
     
-    def _should_trigger_alert(self, reading: WeatherReading, rule: AlertRule) -> bool:
-        """Sprawdza czy reguła powinna wywołać alert"""
+    def apply_episodes(self, reading, triggered, kind, evaluated=None, now=None,
+                       commit=True):
+        """
+        triggered: lista (reguła, wartość, wiadomość, ważność, peak_score)
+        dla reguł spełnionych przez odczyt. Otwarte epizody rodzaju `kind`,
+        których reguła nie została spełniona (a była oceniana - `evaluated`,
+        None = wszystkie), są zamykane.
+        commit=False: zmiany zostają w pamięci silnika i zapisuje je dopiero
+        flush_episodes() - np. raz na paczkę importu, w jej transakcji.
+        """
+        if not self._episodes_loaded:
+            self.load_open_episodes()
         
-        # Pobierz wartość z odczytu
-        value = self._get_value_from_reading(reading, rule.condition_type)
-        if value is None:
-            return False
+        if now is None:
+            now = datetime.utcnow()
+        city_open = self.open_episodes.setdefault(reading.city, {})
+        triggered_ids = set()
+        generated_alerts = []
         
-        # Konwertuj temperaturę z Kelvinów
-        if rule.condition_type == 'temperature':
-            value = value - 273.15
+        for rule, value, message, severity, score in triggered:
+            triggered_ids.add(rule.id)
+            if severity is None:
+                severity = self._determine_severity(rule, value)
+            
+            episode = city_open.get(rule.id) or self._reopen(reading.city, rule.id, now)
+            if episode is None:
+                alert = self._create_alert(reading, rule, value, message, severity, now)
+                episode = Episode(None, rule.id, kind, score, alert.severity, alert)
+                city_open[rule.id] = episode
+                self._new_episodes.append(episode)
+                generated_alerts.append(alert)
+                continue
+            
+            # Trwający epizod - aktualizacja w miejscu zamiast nowego wiersza
+            peak_value = None
+            if score > episode.peak_score:
+                episode.peak_score = score
+                peak_value = value
+            if SEVERITY_RANK.get(severity, 0) > SEVERITY_RANK.get(episode.severity, 0):
+                episode.severity = severity
+            self._record_change(episode, last_seen=now, triggers=1, peak_value=peak_value)
         
-        # (żeby nie spamować alertami)
-        recent_cutoff = datetime.utcnow() - timedelta(minutes=30)
-        recent_alert = Alert.query.filter(
-            Alert.rule_id == rule.id,
-            Alert.created_at >= recent_cutoff
-        ).first()
+        to_close = [
+            episode for rule_id, episode in city_open.items()
+            if episode.kind == kind and rule_id not in triggered_ids
+            and (evaluated is None or rule_id in evaluated)
+        ]
+        for episode in to_close:
+            del city_open[episode.rule_id]
+            episode.closed_at = now
+            self.recently_closed[episode.rule_id] = (reading.city, episode)
+            self._record_change(episode, closed_at=now)
         
-        if recent_alert:
-            return False
+        if commit and not self.flush_episodes(commit=True):
+            return []
         
-        # Sprawdź warunek
-        operator_func = self.operators.get(rule.operator)
-        if not operator_func:
+        for alert in generated_alerts:
+            print(f"✓ Alert wygenerowany: {alert.message}")
+        return generated_alerts
+    
+    def _record_change(self, episode: Episode, last_seen=None, triggers=0,
+                       peak_value=None, closed_at=None):
+        """Zapamiętuje zmianę epizodu do zapisu w flush_episodes()"""
+        alert = episode.alert
+        if alert is not None:
+            # Alert jeszcze niezapisany - zmiana wprost na obiekcie
+            if last_seen is not None:
+                alert.last_seen = last_seen
+            if peak_value is not None:
+                alert.peak_value = peak_value
+            if triggers:
+                alert.trigger_count += triggers
+            if alert.severity != episode.severity:
+                alert.severity = episode.severity
+            if alert.closed_at != closed_at:
+                alert.closed_at = closed_at
+            return
+        self._changes.append({
+            'b_id': episode.alert_id, 'b_last_seen': last_seen, 'b_triggers': triggers,
+            'b_peak_value': peak_value, 'b_severity': episode.severity, 'b_closed_at': closed_at
+        })
+    
+    def flush_episodes(self, commit: bool = False) -> bool:
+        """
+        Zapisuje zebrane zmiany epizodów: nowe alerty jednym flushem, a zmiany
+        trwających i zamykanych epizodów jednym UPDATE (executemany, w kolejności
+        zdarzeń). commit=False zostawia transakcję wywołującemu i rzuca błąd dalej;
+        commit=True zatwierdza, a błąd wycofuje i zgłasza jako False.
+        """
+        new_episodes, self._new_episodes = self._new_episodes, []
+        changes, self._changes = self._changes, []
+        if not (new_episodes or changes):
+            return True
+        
+        table = Alert.__table__
+        try:
+            stale = False
+            if changes:
+                result = db.session.execute(
+                    update(table)
+                    .where(table.c.id == bindparam('b_id'))
+                    .values(last_seen=func.coalesce(bindparam('b_last_seen', type_=table.c.last_seen.type),
+                                              table.c.last_seen),
+                            trigger_count=table.c.trigger_count + bindparam('b_triggers'),
+                            peak_value=func.coalesce(bindparam('b_peak_value'),
+                                                     table.c.peak_value),
+                            severity=bindparam('b_severity'),
+                            closed_at=bindparam('b_closed_at')),
+                    changes
+                )
+                stale = 0 <= result.rowcount < len(changes)
+            
+            # flush nadaje id nowym alertom
+            db.session.flush()
+            if commit:
+                db.session.commit()
+        except Exception as e:
+            self._episodes_loaded = False
+            if not commit:
+                raise
+            print(f"✗ Błąd podczas zapisu epizodów alertów: {e}")
+            db.session.rollback()
             return False
         
-        return operator_func(value, rule.threshold)
+        for episode in new_episodes:
+            episode.alert_id = episode.alert.id
+            episode.alert = None
+        
+        if stale:
+            # Część alertów usunięto przez API - odśwież stan z bazy
+            self.load_open_episodes()
+        return True
     
-    def _get_value_from_reading(self, reading: WeatherReading, condition_type: str):
-        """Pobiera odpowiednią wartość z odczytu pogodowego"""
-        value_map = {
-            'temperature': reading.temperature,
-            'humidity': reading.humidity,
-            'pressure': reading.pressure,
-            'wind_speed': reading.wind_speed
-        }
-        return value_map.get(condition_type)
+    def close_open_episodes(self) -> int:
+        """Zamyka wszystkie epizody tej instancji z czasem ostatniego wystąpienia"""
+        self.flush_episodes()
+        ids = [episode.alert_id for episodes in self.open_episodes.values()
+               for episode in episodes.values()]
+        if ids:
+            db.session.execute(
+                update(Alert.__table__)
+                .where(Alert.__table__.c.id.in_(ids))
+                .values(closed_at=Alert.__table__.c.last_seen)
+            )
+            db.session.commit()
+        self.open_episodes = {}
+        return len(ids)
     
-    def _create_alert(self, reading: WeatherReading, rule: AlertRule) -> Alert:
-        """Tworzy nowy alert"""
-        
-        value = self._get_value_from_reading(reading, rule.condition_type)
-        if rule.condition_type == 'temperature':
-            value = value - 273.15
+    def open_rule_ids(self, city: str, kind: str) -> set:
+        """Id reguł z otwartym epizodem danego rodzaju w mieście"""
+        if not self._episodes_loaded:
+            self.load_open_episodes()
+        return {rule_id for rule_id, episode in self.open_episodes.get(city, {}).items()
+                if episode.kind == kind}
+    
+    def _reopen(self, city: str, rule_id: int, now: datetime):
+        """Wznawia niedawno zamknięty epizod reguły"""
+        closed = self.recently_closed.pop(rule_id, None)
+        if closed is None:
+            return None
+        closed_city, episode = closed
+        if closed_city != city or now - episode.closed_at > self.reopen_window:
+            return None
+        episode.closed_at = None
+        self.open_episodes[city][rule_id] = episode
+        return episode
+    
+    def _create_alert(self, reading, rule: CompiledRule, value: float,
+                      message: str = None, severity: str = None,
+                      now: datetime = None) -> Alert:
+        """Tworzy nowy alert (otwiera epizod) - zapis razem z resztą zmian"""
         
-        # Generuj wiadomość
-        message = self._generate_message(rule, value, reading.city)
+        # Wiadomość z gotowego szablonu reguły
+        if message is None:
+            message = rule.message(value)
         
         # Określ poziom ważności
-        severity = self._determine_severity(rule, value)
+        if severity is None:
+            severity = self._determine_severity(rule, value)
         
+        if now is None:
+            now = datetime.utcnow()
         alert = Alert(
             rule_id=rule.id,
             city=reading.city,
             message=message,
             severity=severity,
             value=value,
-            is_read=False
+            peak_value=value,
+            is_read=False,
+            created_at=now,
+            last_seen=now,
+            trigger_count=1
         )
-        
-        try:
-            db.session.add(alert)
-            db.session.commit()
-            print(f"✓ Alert wygenerowany: {message}")
-            return alert
-        except Exception as e:
-            print(f"✗ Błąd podczas tworzenia alertu: {e}")
-            db.session.rollback()
-            return None
-    
-    def _generate_message(self, rule: AlertRule, value: float, city: str) -> str:
-        """Generuje czytelną wiadomość alertu"""
-        
-        unit_map = {
-            'temperature': '°C',
-            'humidity': '%',
-            'pressure': 'hPa',
-            'wind_speed': 'm/s'
-        }
-        
-        condition_names = {
-            'temperature': 'Temperatura',
-            'humidity': 'Wilgotność',
-            'pressure': 'Ciśnienie',
-            'wind_speed': 'Prędkość wiatru'
-        }
-        
-        unit = unit_map.get(rule.condition_type, '')
-        condition_name = condition_names.get(rule.condition_type, rule.condition_type)
-        
-        return (f"{rule.name}: {condition_name} w {city} wynosi {value:.1f}{unit}, "
-                f"co przekracza próg {rule.threshold}{unit}")
+        db.session.add(alert)
+        return alert
     
-    def _determine_severity(self, rule: AlertRule, value: float) -> str:
+    def _determine_severity(self, rule: CompiledRule, value: float) -> str:
         """Określa poziom ważności alertu"""
         
         
@@ -217,4 +386,69 @@ DEFAULT_ALERT_RULES = [
         'operator': '>',
         'threshold': 15.0,
     },
-]
\ No newline at end of file
+    # Reguły anomalii - próg to limit z-score względem normy miasta
+    {
+        'name': 'Anomalia temperatury',
+        'condition_type': 'temperature',
+        'operator': 'anomaly',
+        'threshold': 4.0,
+    },
+    {
+        'name': 'Anomalia ciśnienia',
+        'condition_type': 'pressure',
+        'operator': 'anomaly',
+        'threshold': 4.0,
+    },
+    {
+        'name': 'Anomalia wiatru',
+        'condition_type': 'wind_speed',
+        'operator': 'anomaly',
+        'threshold': 4.0,
+    },
+]
+
+
+# Limit parametrów w jednym IN (...) dla starszych wersji SQLite
+_SEED_CHUNK = 500
+
+
+def seed_default_rules(cities, templates=DEFAULT_ALERT_RULES) -> int:
+    """
+    Tworzy brakujące domyślne reguły dla miast operacją zbiorową:
+    jedno zapytanie o istniejące reguły i jeden insert (executemany)
+    na paczkę miast. Idempotentne - istniejące reguły są pomijane.
+    Zwraca liczbę utworzonych reguł.
+    """
+    cities = list(dict.fromkeys(cities))
+    now = datetime.utcnow()
+    created = 0
+
+    for start in range(0, len(cities), _SEED_CHUNK):
+        chunk = cities[start:start + _SEED_CHUNK]
+        existing = set(db.session.execute(
+            select(AlertRule.city, AlertRule.name, AlertRule.condition_type)
+            .where(AlertRule.city.in_(chunk))
+        ).all())
+
+        rows = [
+            {
+                'name': template['name'],
+                'city': city,
+                'condition_type': template['condition_type'],
+                'operator': template['operator'],
+                'threshold': template['threshold'],
+                'is_active': True,
+                'created_at': now
+            }
+            for city in chunk
+            for template in templates
+            if (city, template['name'], template['condition_type']) not in existing
+        ]
+        if rows:
+            db.session.execute(insert(AlertRule.__table__), rows)
+            created += len(rows)
+
+    db.session.commit()
+    # Core insert omija zdarzenia ORM, więc cache reguł czyścimy ręcznie
+    rule_cache.invalidate()
+    return created
@@ -0,0 +1,173 @@
+"""
+Anomaly Detector
+Wykrywa nietypowe odczyty względem wyuczonej normy miasta zamiast
+stałych progów. Dla każdej trójki (miasto, metryka, godzina doby)
+trzyma wykładniczo ważoną średnią i wariancję w zwartych tablicach;
+ocena odczytu to O(1) na metrykę.
+"""
+
+import math
+import os
+from array import array
+
+from sqlalchemy import func, select
+
+from app import db
+from app.models import WeatherReading
+from app.readings import METRICS
+from app.rule_index import CONDITION_NAMES, KELVIN_OFFSET, UNIT_MAP
+
+
+ANOMALY_ALPHA = float(os.getenv('ANOMALY_ALPHA', 0.05))
+# Ile odczytów w danej godzinie zanim zaczniemy oceniać
+ANOMALY_MIN_SAMPLES = int(os.getenv('ANOMALY_MIN_SAMPLES', 24))
+
+# Minimalne odchylenie standardowe - przy prawie stałych wartościach
+# (np. ciśnienie w hPa) wariancja bliska zeru dawałaby ogromne z-score
+MIN_STD = {
+    'temperature': 0.5,
+    'humidity': 2.0,
+    'pressure': 1.0,
+    'wind_speed': 0.5
+}
+
+HOURS = 24
+_SLOTS_PER_CITY = len(METRICS) * HOURS
+_METRIC_OFFSET = {metric: i * HOURS for i, metric in enumerate(METRICS)}
+
+
+class AnomalyDetector:
+    """Bazowe normy per (miasto, metryka, godzina) i ocena z-score"""
+
+    def __init__(self, alert_engine, alpha: float = ANOMALY_ALPHA,
+                 min_samples: int = ANOMALY_MIN_SAMPLES):
+        self.alert_engine = alert_engine
+        self.alpha = alpha
+        self.min_samples = min_samples
+
+        self.city_slots = {}          # miasto -> początek bloku w tablicach
+        self.mean = array('d')
+        self.var = array('d')
+        self.count = array('l')
+
+    def _city_base(self, city: str) -> int:
+        base = self.city_slots.get(city)
+        if base is None:
+            base = self.city_slots[city] = len(self.mean)
+            self.mean.extend([0.0] * _SLOTS_PER_CITY)
+            self.var.extend([0.0] * _SLOTS_PER_CITY)
+            self.count.extend([0] * _SLOTS_PER_CITY)
+        return base
+
+    def score(self, reading) -> dict:
+        """
+        Zwraca {metryka: (z, średnia)} dla odczytu i aktualizuje normy.
+        Metryki bez wystarczającej historii są pomijane.
+        """
+        base = self._city_base(reading.city)
+        hour = (reading.timestamp // 3600) % HOURS
+        alpha = self.alpha
+        scores = {}
+
+        for metric in METRICS:
+            value = getattr(reading, metric)
+            i = base + _METRIC_OFFSET[metric] + hour
+            n = self.count[i]
+
+            if n == 0:
+                self.mean[i] = value
+                self.var[i] = 0.0
+                self.count[i] = 1
+                continue
+
+            mean = self.mean[i]
+            diff = value - mean
+            if n >= self.min_samples:
+                std = max(math.sqrt(self.var[i]), MIN_STD[metric])
+                scores[metric] = (diff / std, mean)
+
+            # Aktualizacja EWMA średniej i wariancji
+            increment = alpha * diff
+            self.mean[i] = mean + increment
+            self.var[i] = (1 - alpha) * (self.var[i] + diff * increment)
+            self.count[i] = n + 1
+
+        return scores
+
+    def check_reading(self, reading):
+        """
+        Ocenia odczyt i prowadzi epizody alertów dla metryk, które mają
+        aktywną regułę anomalii miasta: |z| ponad próg otwiera/aktualizuje
+        epizod, powrót do normy go zamyka
+        """
+        scores = self.score(reading)
+        anomaly_rules = self.alert_engine.rules.get(reading.city).anomaly
+
+        # Epizody reguł wyłączonych lub usuniętych też trzeba zamknąć
+        active_ids = {rule.id for rules in anomaly_rules.values() for rule in rules}
+        evaluated = self.alert_engine.open_rule_ids(reading.city, 'anomaly') - active_ids
+        if not (scores and anomaly_rules) and not evaluated:
+            return []
+
+        triggered = []
+        for metric, rules in anomaly_rules.items():
+            if metric not in scores:
+                continue
+            z, mean = scores[metric]
+            value = getattr(reading, metric)
+            if metric == 'temperature':
+                value -= KELVIN_OFFSET
+                mean -= KELVIN_OFFSET
+
+            # Każda reguła metryki (np. różne progi) prowadzi własny epizod
+            for rule in rules:
+                evaluated.add(rule.id)
+                if abs(z) <= rule.threshold:
+                    continue
+                triggered.append((
+                    rule, value,
+                    self._generate_message(rule, reading.city, value, mean, z),
+                    'critical' if abs(z) >= 2 * rule.threshold else 'warning',
+                    abs(z)
+                ))
+
+        return self.alert_engine.apply_episodes(reading, triggered, kind='anomaly',
+                                                evaluated=evaluated)
+
+    def _generate_message(self, rule, city: str, value: float, mean: float, z: float) -> str:
+        unit = UNIT_MAP.get(rule.condition_type, '')
+        condition_name = CONDITION_NAMES.get(rule.condition_type, rule.condition_type)
+        return (f"{rule.name}: {condition_name} w {city} wynosi {value:.1f}{unit}, "
+                f"odchylenie {z:+.1f}σ od normy {mean:.1f}{unit} o tej porze")
+
+    def bootstrap(self) -> int:
+        """
+        Buduje normy z istniejącej historii jednym zapytaniem agregującym
+        (średnia i średnia kwadratów per miasto i godzina liczone w bazie).
+        Zwraca liczbę wypełnionych grup (miasto, godzina).
+        """
+        hour = ((WeatherReading.timestamp // 3600) % HOURS).label('hour')
+        columns = [WeatherReading.city, hour, func.count()]
+        for metric in METRICS:
+            column = getattr(WeatherReading, metric)
+            columns += [func.avg(column), func.avg(column * column)]
+
+        rows = db.session.execute(
+            select(*columns).group_by(WeatherReading.city, hour)
+        )
+
+        groups = 0
+        for city, hour_value, n, *aggregates in rows:
+            base = self._city_base(city)
+            for m, metric in enumerate(METRICS):
+                mean, mean_sq = aggregates[2 * m], aggregates[2 * m + 1]
+                if mean is None:
+                    continue
+                i = base + _METRIC_OFFSET[metric] + int(hour_value)
+                self.mean[i] = mean
+                self.var[i] = max(0.0, mean_sq - mean * mean)
+                self.count[i] = n
+            groups += 1
+
+        print(f"Anomaly baselines bootstrapped for {len(self.city_slots)} cities ({groups} city-hour groups)")
+        return groups
@@ -0,0 +1,183 @@
+"""
+City Registry
+Rejestr miast: import zbiorczy z CSV/JSON i upsert operacjami na zbiorach
+(jedno zapytanie o istniejące miasta, insert i update przez executemany)
+"""
+
+import csv
+import io
+import json
+from datetime import datetime
+
+from sqlalchemy import bindparam, func, insert, select, update
+
+from app import db
+from app.alerts import seed_default_rules
+from app.geo import invalidate_after_commit
+from app.models import City, WeatherReading
+from app.readings import update_latest_readings
+
+
+# Miasta tworzone, gdy rejestr jest pusty
+DEFAULT_CITIES = [
+    {'name': 'Warszawa', 'lat': 52.15, 'lon': 21.0},
+    {'name': 'Yakutsk', 'lat': 62.03, 'lon': 129.73},
+]
+
+# Limit parametrów w jednym IN (...) dla starszych wersji SQLite
+_CHUNK = 500
+
+
+def _optional_float(value):
+    if value is None or value == '':
+        return None
+    if isinstance(value, (list, dict)):
+        # float() rzuca wtedy TypeError - dla wywołującego to zwykły błąd danych
+        raise ValueError(f'Expected a number, got {type(value).__name__}')
+    return float(value)
+
+
+def _parse_bool(value, default=True):
+    if value is None or value == '':
+        return default
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'tak')
+
+
+def normalize_city(row: dict) -> dict:
+    """
+    Sprawdza i normalizuje jeden wiersz importu (ValueError gdy niepoprawny).
+    Pola nie podane (brak kolumny lub pusta wartość) są None - upsert
+    zostawia wtedy obecną wartość istniejącego miasta.
+    """
+    if not isinstance(row, dict):
+        raise ValueError(f'Expected an object, got {type(row).__name__}')
+    name = row.get('name') or row.get('city') or ''
+    if not isinstance(name, str) or not name.strip():
+        raise ValueError('Missing city name')
+    name = name.strip()
+
+    lat = _optional_float(row.get('lat'))
+    lon = _optional_float(row.get('lon'))
+    if lat is not None and not -90 <= lat <= 90:
+        raise ValueError(f'Invalid lat for {name}: {lat}')
+    if lon is not None and not -180 <= lon <= 180:
+        raise ValueError(f'Invalid lon for {name}: {lon}')
+
+    return {
+        'name': name,
+        'lat': lat,
+        'lon': lon,
+        'is_active': _parse_bool(row.get('is_active'), default=None)
+    }
+
+
+def parse_city_import(text: str, fmt: str) -> list:
+    """
+    Parsuje dane importu: 'csv' (nagłówek name,lat,lon[,is_active])
+    albo 'json' (lista obiektów lub {"cities": [...]})
+    """
+    if fmt == 'csv':
+        rows = list(csv.DictReader(io.StringIO(text)))
+    elif fmt == 'json':
+        data = json.loads(text)
+        rows = data.get('cities', []) if isinstance(data, dict) else data
+    else:
+        raise ValueError(f'Unsupported import format: {fmt}')
+
+    # Ostatni wiersz dla danej nazwy wygrywa
+    cities = {}
+    for row in rows:
+        city = normalize_city(row)
+        cities[city['name']] = city
+    return list(cities.values())
+
+
+def upsert_cities(cities: list) -> dict:
+    """
+    Wstawia nowe miasta i aktualizuje istniejące (po nazwie) operacjami
+    zbiorowymi. Nie commituje. Zwraca {'created': n, 'updated': m}.
+    """
+    created = updated = 0
+    now = datetime.utcnow()
+
+    for start in range(0, len(cities), _CHUNK):
+        chunk = cities[start:start + _CHUNK]
+        existing = set(db.session.execute(
+            select(City.name).where(City.name.in_([c['name'] for c in chunk]))
+        ).scalars())
+
+        new_rows = [
+            dict(city, is_active=city['is_active'] is not False, created_at=now)
+            for city in chunk if city['name'] not in existing
+        ]
+        changed_rows = [
+            {'b_name': c['name'], 'b_lat': c['lat'], 'b_lon': c['lon'],
+             'b_is_active': c['is_active']}
+            for c in chunk if c['name'] in existing
+        ]
+
+        if new_rows:
+            db.session.execute(insert(City.__table__), new_rows)
+            created += len(new_rows)
+        if changed_rows:
+            # Aktualizowane są tylko pola podane w imporcie
+            table = City.__table__
+            db.session.execute(
+                update(table)
+                .where(table.c.name == bindparam('b_name'))
+                .values(lat=func.coalesce(bindparam('b_lat'), table.c.lat),
+                        lon=func.coalesce(bindparam('b_lon'), table.c.lon),
+                        is_active=func.coalesce(bindparam('b_is_active'), table.c.is_active)),
+                changed_rows
+            )
+            updated += len(changed_rows)
+
+        # Miasta dodane po fakcie mogą już mieć odczyty
+        if new_rows:
+            update_latest_readings([row['name'] for row in new_rows])
+
+    # Core insert/update omija zdarzenia ORM - indeks przestrzenny od nowa po commit
+    invalidate_after_commit(db.session)
+    return {'created': created, 'updated': updated}
+
+
+def import_cities(cities: list, seed_rules: bool = True) -> dict:
+    """Upsert miast i (opcjonalnie) domyślnych reguł dla aktywnych miast"""
+    result = upsert_cities(cities)
+    db.session.commit()
+
+    result['rules_created'] = 0
+    if seed_rules:
+        # Aktywność wg stanu po upsercie (wiersz mógł jej nie podawać)
+        names = [c['name'] for c in cities]
+        active = []
+        for start in range(0, len(names), _CHUNK):
+            active.extend(db.session.execute(
+                select(City.name).where(City.name.in_(names[start:start + _CHUNK]),
+                                        City.is_active.is_(True))
+            ).scalars())
+        result['rules_created'] = seed_default_rules(active)
+    return result
+
+
+def ensure_default_cities() -> int:
+    """
+    Wypełnia pusty rejestr domyślnymi miastami i miastami, z których
+    są już odczyty (baza sprzed rejestru - collector ich nie zgubi)
+    """
+    if db.session.execute(select(City.id).limit(1)).first():
+        return 0
+    cities = {c['name']: normalize_city(c) for c in DEFAULT_CITIES}
+    for name in db.session.execute(select(WeatherReading.city).distinct()).scalars():
+        cities.setdefault(name, normalize_city({'name': name}))
+    result = upsert_cities(list(cities.values()))
+    db.session.commit()
+    return result['created']
+
+
+def active_city_names() -> list:
+    return list(db.session.execute(
+        select(City.name).where(City.is_active.is_(True)).order_by(City.name)
+    ).scalars())
@@ -0,0 +1,127 @@
+"""
+Response Encoding
+Kolumnowy format dużych odpowiedzi historii (jedna tablica na pole,
+znaczniki czasu kodowane różnicowo), szybszy enkoder JSON (orjson,
+jeśli zainstalowany) i kompresja gzip/brotli wg Accept-Encoding
+"""
+
+import gzip
+import json
+from datetime import datetime, timedelta
+
+from flask import Response
+
+try:
+    import orjson
+except ImportError:  # opcjonalna zależność
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # opcjonalna zależność
+    brotli = None
+
+
+# Mniejszych odpowiedzi nie opłaca się kompresować
+MIN_COMPRESS_SIZE = 1024
+
+_EPOCH = datetime(1970, 1, 1)
+_MILLISECOND = timedelta(milliseconds=1)
+
+
+def dumps(obj) -> bytes:
+    """Serializacja JSON - orjson gdy dostępny, inaczej zwarty json"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def delta_encode(values) -> dict:
+    """[t0, t1, t2] -> {'base': t0, 'deltas': [t1 - t0, t2 - t1]}"""
+    if not values:
+        return {'base': None, 'deltas': []}
+    deltas = [b - a for a, b in zip(values, values[1:])]
+    return {'base': values[0], 'deltas': deltas}
+
+
+def dictionary_encode(values) -> dict:
+    """Powtarzalne napisy jako słownik + kody"""
+    index = {}
+    codes = [index.setdefault(value, len(index)) for value in values]
+    return {'values': list(index), 'codes': codes}
+
+
+def epoch_ms(value: datetime):
+    if value is None:
+        return None
+    return (value - _EPOCH) // _MILLISECOND
+
+
+def columnar_readings(rows) -> dict:
+    """
+    Odczyty (id, temperature, humidity, pressure, wind_speed, weather,
+    timestamp, received_at) w układzie kolumnowym
+    """
+    if rows:
+        ids, temperature, humidity, pressure, wind_speed, weather, timestamp, received_at = zip(*rows)
+    else:
+        ids = temperature = humidity = pressure = wind_speed = weather = timestamp = received_at = ()
+
+    received_ms = [epoch_ms(value) for value in received_at]
+    return {
+        'count': len(rows),
+        'columns': {
+            'id': delta_encode(list(ids)),
+            'temperature': list(temperature),
+            'humidity': list(humidity),
+            'pressure': list(pressure),
+            'wind_speed': list(wind_speed),
+            'weather': dictionary_encode(weather),
+            'timestamp': delta_encode(list(timestamp)),
+            # epoch ms (UTC); brak wartości zastępowany zerem
+            'received_at': delta_encode([value or 0 for value in received_ms])
+        }
+    }
+
+
+def negotiate_encoding(accept_encoding: str):
+    """Wybiera 'br' lub 'gzip' z nagłówka Accept-Encoding (z uwzględnieniem q=0)"""
+    accepted = {}
+    for part in (accept_encoding or '').split(','):
+        token, _, params = part.strip().partition(';')
+        token = token.strip().lower()
+        if not token:
+            continue
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[token] = quality
+
+    def allowed(name):
+        return accepted.get(name, accepted.get('*', 0.0)) > 0
+
+    if brotli is not None and allowed('br'):
+        return 'br'
+    if allowed('gzip'):
+        return 'gzip'
+    return None
+
+
+def encoded_json_response(obj, accept_encoding: str = None, status: int = 200) -> Response:
+    """Odpowiedź JSON z szybkim enkoderem i negocjowaną kompresją"""
+    body = dumps(obj)
+    headers = {'Vary': 'Accept-Encoding'}
+
+    encoding = negotiate_encoding(accept_encoding) if len(body) >= MIN_COMPRESS_SIZE else None
+    if encoding == 'br':
+        body = brotli.compress(body, quality=5)
+        headers['Content-Encoding'] = 'br'
+    elif encoding == 'gzip':
+        body = gzip.compress(body, compresslevel=6)
+        headers['Content-Encoding'] = 'gzip'
+
+    return Response(body, status=status, mimetype='application/json', headers=headers)
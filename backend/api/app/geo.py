@@ -0,0 +1,176 @@
+"""
+Spatial Index
+Indeks siatkowy (grid) nad współrzędnymi miast z rejestru.
+Zapytania o promień i prostokąt sprawdzają tylko komórki siatki
+pokrywające obszar, a nie wszystkie miasta.
+"""
+
+import math
+import os
+import time
+
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session, object_session
+
+from app import db
+from app.models import City
+
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = 111.195
+
+# Rozmiar komórki siatki w stopniach
+GRID_CELL_DEG = float(os.getenv('GRID_CELL_DEG', 1.0))
+
+# Jak długo indeks jest ważny bez sygnału o zmianie
+# (miasta dodane poza tym procesem, np. przez init_alerts.py albo inny shard API)
+CITY_INDEX_TTL = float(os.getenv('CITY_INDEX_TTL', 60))
+
+
+def haversine_km(lat1, lon1, lat2, lon2) -> float:
+    """Odległość po wielkim kole w kilometrach"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlmb = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlmb / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+class GridIndex:
+    """Siatka lat/lon: komórka -> lista (nazwa, lat, lon)"""
+
+    def __init__(self, points=(), cell_deg: float = GRID_CELL_DEG):
+        self.cell_deg = cell_deg
+        self.lon_cells = int(math.ceil(360 / cell_deg))
+        self.cells = {}
+        self.size = 0
+        for name, lat, lon in points:
+            self.add(name, lat, lon)
+
+    def _cell_y(self, lat):
+        return int(math.floor((lat + 90) / self.cell_deg))
+
+    def _cell_x(self, lon):
+        return int(math.floor((lon + 180) / self.cell_deg)) % self.lon_cells
+
+    def add(self, name, lat, lon):
+        key = (self._cell_y(lat), self._cell_x(lon))
+        self.cells.setdefault(key, []).append((name, lat, lon))
+        self.size += 1
+
+    def _lon_range(self, min_lon, max_lon):
+        """
+        Indeksy kolumn siatki dla zakresu długości min_lon..max_lon
+        (max_lon może wychodzić poza 180° - zakres zawija się przez antypołudnik)
+        """
+        # Kolumny liczone bez modulo, żeby zawinięcie wynikało z zakresu, a nie z indeksów
+        start = int(math.floor((min_lon + 180) / self.cell_deg))
+        end = int(math.floor((max_lon + 180) / self.cell_deg))
+        if end - start + 1 >= self.lon_cells:
+            return range(self.lon_cells)
+        return [x % self.lon_cells for x in range(start, end + 1)]
+
+    def _candidates(self, min_lat, max_lat, lon_columns):
+        y_start = self._cell_y(max(-90.0, min_lat))
+        y_end = self._cell_y(min(90.0, max_lat))
+        for y in range(y_start, y_end + 1):
+            for x in lon_columns:
+                cell = self.cells.get((y, x))
+                if cell:
+                    yield from cell
+
+    def within_bbox(self, min_lat, min_lon, max_lat, max_lon) -> list:
+        """Miasta w prostokącie; min_lon > max_lon oznacza przejście przez 180°"""
+        crosses = min_lon > max_lon
+        result = []
+        for name, lat, lon in self._candidates(min_lat, max_lat,
+                                               self._lon_range(min_lon, max_lon + (360 if crosses else 0))):
+            if not min_lat <= lat <= max_lat:
+                continue
+            if crosses:
+                if lon >= min_lon or lon <= max_lon:
+                    result.append(name)
+            elif min_lon <= lon <= max_lon:
+                result.append(name)
+        return result
+
+    def within_radius(self, lat, lon, radius_km) -> list:
+        """Miasta w promieniu, posortowane po odległości: [(nazwa, km)]"""
+        dlat = radius_km / KM_PER_DEGREE
+        min_lat, max_lat = lat - dlat, lat + dlat
+
+        # Przy biegunach okrąg obejmuje wszystkie długości geograficzne
+        cos_lat = math.cos(math.radians(min(89.9, max(abs(min_lat), abs(max_lat)))))
+        if min_lat <= -90 or max_lat >= 90 or radius_km / (KM_PER_DEGREE * cos_lat) >= 180:
+            lon_columns = range(self.lon_cells)
+        else:
+            dlon = radius_km / (KM_PER_DEGREE * cos_lat)
+            lon_columns = self._lon_range(lon - dlon, lon + dlon)
+
+        result = []
+        for name, city_lat, city_lon in self._candidates(min_lat, max_lat, lon_columns):
+            distance = haversine_km(lat, lon, city_lat, city_lon)
+            if distance <= radius_km:
+                result.append((name, distance))
+        result.sort(key=lambda item: item[1])
+        return result
+
+
+class CityIndexCache:
+    """Indeks miast budowany leniwie i unieważniany przy zmianach rejestru albo po TTL"""
+
+    def __init__(self, ttl: float = CITY_INDEX_TTL):
+        self.ttl = ttl
+        self._index = None
+        self._built_at = 0.0
+
+    def get(self) -> GridIndex:
+        if self._index is None or time.monotonic() - self._built_at > self.ttl:
+            rows = db.session.execute(
+                select(City.name, City.lat, City.lon).where(
+                    City.is_active.is_(True),
+                    City.lat.isnot(None),
+                    City.lon.isnot(None)
+                )
+            )
+            self._index = GridIndex(rows)
+            self._built_at = time.monotonic()
+        return self._index
+
+    def invalidate(self):
+        self._index = None
+
+
+city_index = CityIndexCache()
+
+
+# Indeks unieważniany dopiero po commit - przebudowany między flush
+# a commit widziałby stary stan rejestru
+_PENDING_KEY = 'city_index_stale'
+
+
+def invalidate_after_commit(session):
+    """Oznacza indeks do przebudowy po commicie sesji (zmiany przez Core insert/update)"""
+    session.info[_PENDING_KEY] = True
+
+
+@event.listens_for(City, 'after_insert')
+@event.listens_for(City, 'after_update')
+@event.listens_for(City, 'after_delete')
+def _collect_changed_city(mapper, connection, target):
+    session = object_session(target)
+    if session is None:
+        city_index.invalidate()
+    else:
+        invalidate_after_commit(session)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_city_index(session):
+    if session.info.pop(_PENDING_KEY, False):
+        city_index.invalidate()
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_city_changes(session, previous_transaction):
+    session.info.pop(_PENDING_KEY, None)
@@ -9,6 +9,11 @@ from datetime import datetime
 
 class WeatherReading(db.Model):
     __tablename__ = 'weather_readings'
+    __table_args__ = (
+        # Najnowszy odczyt i zakresy czasu per miasto; unikalność sprawia,
+        # że ponownie dostarczona wiadomość MQTT (QoS 1) nie dubluje odczytu
+        db.Index('uq_weather_readings_city_timestamp', 'city', 'timestamp', unique=True),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     city = db.Column(db.String(100), nullable=False, index=True)
@@ -34,6 +39,31 @@ class WeatherReading(db.Model):
         }
 
 
+class City(db.Model):
+    """Rejestr monitorowanych miast (czyta go collector i seeder reguł)"""
+    __tablename__ = 'cities'
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False, unique=True, index=True)
+    lat = db.Column(db.Float)
+    lon = db.Column(db.Float)
+    is_active = db.Column(db.Boolean, default=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Najnowszy odczyt miasta (utrzymywany przy zapisie odczytów)
+    latest_reading_id = db.Column(db.Integer)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'lat': self.lat,
+            'lon': self.lon,
+            'is_active': self.is_active,
+            'created_at': self.created_at.isoformat(),
+            'latest_reading_id': self.latest_reading_id
+        }
+
+
 class AlertRule(db.Model):
     """Reguły alertów definiowane przez użytkownika"""
     __tablename__ = 'alert_rules'
@@ -42,7 +72,7 @@ class AlertRule(db.Model):
     name = db.Column(db.String(100), nullable=False)
     city = db.Column(db.String(100), nullable=False, index=True)
     condition_type = db.Column(db.String(50), nullable=False)  # 'temperature', 'humidity', etc.
-    operator = db.Column(db.String(10), nullable=False)  # '>', '<', '>=', '<=', '=='
+    operator = db.Column(db.String(10), nullable=False)  # '>', '<', '>=', '<=', '==', 'anomaly'
     threshold = db.Column(db.Float, nullable=False)
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -72,6 +102,11 @@ class Alert(db.Model):
     value = db.Column(db.Float, nullable=False)  # Wartość która wywołała alert
     is_read = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    # Epizod: alert trwa dopóki warunek jest spełniony, potem jest zamykany
+    peak_value = db.Column(db.Float)  # Najbardziej skrajna wartość w epizodzie
+    last_seen = db.Column(db.DateTime, default=datetime.utcnow)
+    trigger_count = db.Column(db.Integer, default=1)
+    closed_at = db.Column(db.DateTime)  # NULL = epizod otwarty
 
     rule = db.relationship('AlertRule', backref='alerts')
 
@@ -84,5 +119,25 @@ class Alert(db.Model):
             'severity': self.severity,
             'value': self.value,
             'is_read': self.is_read,
-            'created_at': self.created_at.isoformat()
-        }
\ No newline at end of file
+            'created_at': self.created_at.isoformat(),
+            'peak_value': self.peak_value,
+            'last_seen': self.last_seen.isoformat() if self.last_seen else None,
+            'trigger_count': self.trigger_count,
+            'closed_at': self.closed_at.isoformat() if self.closed_at else None,
+            'is_open': self.closed_at is None
+        }
+
+class ReadingSketch(db.Model):
+    """Szkic kwantyli (KLL) jednej metryki miasta z jednego dnia UTC"""
+    __tablename__ = 'reading_sketches'
+    __table_args__ = (
+        db.Index('uq_reading_sketches_city_metric_day', 'city', 'metric', 'day', unique=True),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    city = db.Column(db.String(100), nullable=False)
+    metric = db.Column(db.String(20), nullable=False)
+    day = db.Column(db.Integer, nullable=False)  # dni od 1970-01-01 (timestamp // 86400)
+    count = db.Column(db.Integer, nullable=False)  # liczba odczytów w szkicu
+    data = db.Column(db.LargeBinary, nullable=False)  # KLLSketch.to_bytes()
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -5,28 +5,71 @@ i sprawdza reguły alertów, generując alerty w razie potrzeby
 """
 
 import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 import json
 import os
+import queue
+import threading
+from sqlalchemy.exc import OperationalError
 from app import db
-from app.models import WeatherReading
+from app.readings import ReadingRecord, insert_readings
 from app.alerts import AlertEngine
+from app.anomaly import AnomalyDetector
+from app.sketches import SketchStore
+
+# Backoff ponawiania zapisu przy przejściowych błędach bazy (sekundy)
+STORE_RETRY_MIN = float(os.getenv("STORE_RETRY_MIN", 0.5))
+STORE_RETRY_MAX = float(os.getenv("STORE_RETRY_MAX", 30))
 
 class MQTTSubscriber:
     
     def __init__(self, app):
         self.app = app
         self.alert_engine = AlertEngine()
+        self.anomaly_detector = AnomalyDetector(self.alert_engine)
+        self.sketch_store = SketchStore()
     
         # MQTT setup
         self.mqtt_broker = os.getenv("MQTT_BROKER", "localhost")
         self.mqtt_port = int(os.getenv("MQTT_PORT", 1883))
         self.mqtt_username = os.getenv("MQTT_USERNAME")
         self.mqtt_password = os.getenv("MQTT_PASSWORD") 
+        self.reconnect_min = int(os.getenv("MQTT_RECONNECT_MIN", 1))
+        self.reconnect_max = int(os.getenv("MQTT_RECONNECT_MAX", 60))
+
+        # Trwała sesja: stały client id (osobny per shard), QoS 1 i potwierdzanie
+        # wiadomości dopiero po zapisie - broker trzyma to, co przyszło podczas restartu
+        shard = os.getenv("MQTT_SHARD")
+        self.client_id = os.getenv("MQTT_CLIENT_ID", "weather_collection")
+        if shard:
+            self.client_id = f"{self.client_id}_{shard}"
+        self.topic = os.getenv("MQTT_TOPIC", "weather/#")
+        self.qos = int(os.getenv("MQTT_QOS", 1))
+        self.protocol_v5 = os.getenv("MQTT_PROTOCOL", "3.1.1") == "5"
+        self.session_expiry = int(os.getenv("MQTT_SESSION_EXPIRY", 86400))
+        # Ile niepotwierdzonych wiadomości broker może wysłać naraz (MQTT 5);
+        # dla 3.1.1 okno ustawia broker (RabbitMQ: mqtt.prefetch)
+        self.receive_maximum = int(os.getenv("MQTT_RECEIVE_MAXIMUM", 100))
 
         self.mqtt_connected = False 
+        self._stopping = threading.Event()
+        # Wiadomości od pętli sieciowej paho do wątku zapisu (rozmiar ogranicza
+        # okno niepotwierdzonych wiadomości brokera - MQTT_RECEIVE_MAXIMUM / prefetch)
+        self._messages = queue.Queue()
+        self._worker = None
+        app.extensions['mqtt_subscriber'] = self
 
-        self.mqtt_client = mqtt.Client(client_id="weather_collection",
-                                        callback_api_version=mqtt.CallbackAPIVersion.VERSION2)
+        if self.protocol_v5:
+            self.mqtt_client = mqtt.Client(client_id=self.client_id,
+                                            protocol=mqtt.MQTTv5,
+                                            callback_api_version=mqtt.CallbackAPIVersion.VERSION2)
+        else:
+            self.mqtt_client = mqtt.Client(client_id=self.client_id,
+                                            clean_session=False,
+                                            protocol=mqtt.MQTTv311,
+                                            callback_api_version=mqtt.CallbackAPIVersion.VERSION2)
+        self.mqtt_client.manual_ack_set(True)
         self.mqtt_client.on_connect = self._on_connect
         self.mqtt_client.on_disconnect = self._on_disconnect
         self.mqtt_client.on_message = self._on_message
@@ -34,9 +77,10 @@ class MQTTSubscriber:
     def _on_connect(self, client, userdata, flags, reason_code, properties):
         if reason_code == 0:
             self.mqtt_connected = True
-            print(f"Connected to MQTT broker: {self.mqtt_broker}:{self.mqtt_port}")
-            client.subscribe("weather/#")
-            print("Subscribed to weather topics...")
+            print(f"Connected to MQTT broker: {self.mqtt_broker}:{self.mqtt_port} "
+                  f"as {self.client_id} (session present: {flags.session_present})")
+            client.subscribe(self.topic, qos=self.qos)
+            print(f"Subscribed to {self.topic} (QoS {self.qos})...")
         else:
             print(f"Failed to connect to MQTT broker, code {reason_code}")
 
@@ -45,28 +89,63 @@ class MQTTSubscriber:
         print("Disconnected from MQTT broker")
 
     def _on_message(self, client, userdata, message):
-        """Callback when message received from MQTT broker"""
+        """
+        Callback pętli sieciowej paho - tylko przekazuje wiadomość do wątku zapisu,
+        żeby ponawianie zapisu przy niedostępnej bazie nie wstrzymywało keepalive
+        """
+        self._messages.put(message)
+
+    def _store_worker(self):
+        """Wątek zapisu: przetwarza i potwierdza wiadomości po kolei"""
+        while True:
+            message = self._messages.get()
+            if message is None or self._stopping.is_set():
+                # Reszta kolejki zostaje niepotwierdzona - broker dostarczy ją ponownie
+                return
+            try:
+                self._process_message(message)
+            except Exception as e:
+                print(f"✗ Error processing message: {e}")
+
+    def _process_message(self, message):
+        """Zapisuje odczyt z wiadomości, potwierdza ją i sprawdza alerty"""
+        client = self.mqtt_client
         try:
             payload = json.loads(message.payload.decode())
-            city = payload.get('city')
-            print(f"Received message from {message.topic}: {city}")
-
-            with self.app.app_context():
-                # Zapisz odczyt do bazy
-                reading = WeatherReading(
-                    city=payload['city'],
-                    temperature=payload['temperature'],
-                    humidity=payload['humidity'],
-                    pressure=payload['pressure'],
-                    wind_speed=payload['wind_speed'],
-                    weather=payload['weather'],
-                    timestamp=payload['timestamp']
-                )
-
-                db.session.add(reading)
-                db.session.commit()
-                print(f"Saved weather data for {city} to database")
+            print(f"Received message from {message.topic}: {payload.get('city')}")
+            reading = ReadingRecord.from_payload(payload)
+        except KeyError as e:
+            # Błędna wiadomość nigdy się nie zapisze - potwierdzamy, żeby nie blokowała okna
+            print(f"✗ Missing required field in message: {e}")
+            client.ack(message.mid, message.qos)
+            return
+        except (ValueError, AttributeError) as e:
+            print(f"✗ Invalid message payload: {e}")
+            client.ack(message.mid, message.qos)
+            return
+
+        city = reading.city
+        with self.app.app_context():
+            try:
+                inserted = self._store(reading)
+            except Exception as e:
+                # Błąd danych (np. naruszenie ograniczeń) - ponowienie nic nie zmieni
+                print(f"✗ Error storing message: {e}")
+                client.ack(message.mid, message.qos)
+                return
+            if inserted is None:
+                # Zamykanie w trakcie ponawiania - bez potwierdzenia broker dostarczy ponownie
+                return
+
+            # Potwierdzenie dopiero po commicie - wiadomość przerwana przez awarię
+            # procesu zostanie dostarczona ponownie (duplikat jest pomijany)
+            client.ack(message.mid, message.qos)
+            if not inserted:
+                print(f"Duplicate reading for {city} at {reading.timestamp}, skipped")
+                return
+            print(f"Saved weather data for {city} to database")
 
+            try:
                 #Sprawdź alerty dla tego odczytu
                 alerts = self.alert_engine.check_reading(reading)
                 if alerts:
@@ -76,41 +155,76 @@ class MQTTSubscriber:
                 else:
                     print(f"✓ No alerts triggered for {city}")
 
-        except KeyError as e:
-            print(f"✗ Missing required field in message: {e}")
-        except Exception as e:
-            print(f"✗ Error processing message: {e}")
-            import traceback
-            traceback.print_exc()
+                # Anomalie względem wyuczonej normy miasta
+                anomalies = self.anomaly_detector.check_reading(reading)
+                for alert in anomalies:
+                    print(f"   - ANOMALY {alert.severity.upper()}: {alert.message}")
 
-    def connect(self):
-        """Connects to MQTT broker with retry logic"""
-        import time
-        
-        max_retries = 10
-        retry_delay = 3
-        
-        for attempt in range(max_retries):
+            except Exception as e:
+                print(f"✗ Error processing message: {e}")
+                import traceback
+                traceback.print_exc()
+
+    def _store(self, reading):
+        """
+        Zapisuje odczyt razem ze szkicami kwantyli dnia w jednej transakcji.
+        Błędy przejściowe bazy (OperationalError, np. "database is locked")
+        są ponawiane z backoffem aż do skutku - wiadomość czeka niepotwierdzona.
+        Zwraca liczbę dodanych wierszy albo None, gdy subskrybent jest zamykany.
+        """
+        delay = STORE_RETRY_MIN
+        while True:
             try:
-                if self.mqtt_username and self.mqtt_password:
-                    self.mqtt_client.username_pw_set(self.mqtt_username, self.mqtt_password)
+                inserted = insert_readings([reading], commit=False)
+                if inserted:
+                    self.sketch_store.add([reading])
+                db.session.commit()
+                return inserted
+            except OperationalError as e:
+                db.session.rollback()
+                self.sketch_store.reset()
+                print(f"✗ Database unavailable ({e.orig}), retrying in {delay:.1f}s")
+            except Exception:
+                db.session.rollback()
+                self.sketch_store.reset()
+                raise
 
-                print(f"Attempt {attempt + 1}/{max_retries}: Connecting to MQTT broker at {self.mqtt_broker}:{self.mqtt_port}...")
-                self.mqtt_client.connect(self.mqtt_broker, self.mqtt_port, keepalive=60)
-                self.mqtt_client.loop_start()
-                print("Successfully connected to MQTT broker!")
-                return
-                
-            except ConnectionRefusedError as e:
-                if attempt < max_retries - 1:
-                    print(f"✗ Connection refused. Retrying in {retry_delay} seconds...")
-                    time.sleep(retry_delay)
-                else:
-                    print(f"✗ Failed to connect after {max_retries} attempts")
-                    raise e
+            if self._stopping.wait(delay):
+                return None
+            delay = min(delay * 2, STORE_RETRY_MAX)
+
+    def connect(self):
+        """
+        Łączy z brokerem MQTT w tle - nie blokuje startu serwera HTTP.
+        Ponowne próby (także pierwszego połączenia) robi pętla paho
+        z wykładniczym backoffem od MQTT_RECONNECT_MIN do MQTT_RECONNECT_MAX sekund.
+        """
+        if self.mqtt_username and self.mqtt_password:
+            self.mqtt_client.username_pw_set(self.mqtt_username, self.mqtt_password)
+
+        self.mqtt_client.reconnect_delay_set(min_delay=self.reconnect_min,
+                                             max_delay=self.reconnect_max)
+
+        self._worker = threading.Thread(target=self._store_worker, name='mqtt-store', daemon=True)
+        self._worker.start()
+
+        print(f"Connecting to MQTT broker at {self.mqtt_broker}:{self.mqtt_port} in background...")
+        if self.protocol_v5:
+            properties = Properties(PacketTypes.CONNECT)
+            properties.SessionExpiryInterval = self.session_expiry
+            properties.ReceiveMaximum = self.receive_maximum
+            self.mqtt_client.connect_async(self.mqtt_broker, self.mqtt_port, keepalive=60,
+                                           clean_start=False, properties=properties)
+        else:
+            self.mqtt_client.connect_async(self.mqtt_broker, self.mqtt_port, keepalive=60)
+        self.mqtt_client.loop_start()
 
     def disconnect(self):
         """Disconnect from MQTT broker"""
+        self._stopping.set()
+        self._messages.put(None)
+        if self._worker is not None:
+            self._worker.join(timeout=10)
         self.mqtt_client.loop_stop()
         self.mqtt_client.disconnect()
         print("Disconnected from MQTT broker")
\ No newline at end of file
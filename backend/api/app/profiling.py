@@ -0,0 +1,253 @@
+"""
+On-demand Profiling
+Profiluje następne N wiadomości MQTT (MQTTSubscriber._process_message)
+albo następne N żądań do wybranego endpointu. Gdy profilowanie jest
+wyłączone, nic nie jest opakowane - zero narzutu; funkcja jest
+podmieniana na czas sesji i przywracana po N wywołaniach, po upływie
+timeoutu albo po ręcznym zatrzymaniu (zapisywany jest wtedy profil częściowy).
+
+Tryby:
+    cprofile - profiler deterministyczny, wynik .pstats (pstats, snakeviz)
+    sample   - próbkowanie stosu wątku, wynik .collapsed (flamegraph.pl, speedscope)
+"""
+
+import cProfile
+import math
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from functools import wraps
+
+
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+SAMPLE_INTERVAL = float(os.getenv('PROFILE_SAMPLE_INTERVAL', 0.001))
+# Po ilu sekundach sesja kończy się sama, nawet bez N wywołań (rzadki ruch)
+PROFILE_TIMEOUT = float(os.getenv('PROFILE_TIMEOUT', 600))
+MODES = ('cprofile', 'sample')
+
+
+class StackSampler:
+    """Próbkuje stosy wątków wykonujących profilowany kod"""
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self.threads = set()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profiler-sampler', daemon=True)
+        self._thread.start()
+
+    def enable(self):
+        self.threads.add(threading.get_ident())
+
+    def disable(self):
+        self.threads.discard(threading.get_ident())
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            if not self.threads:
+                continue
+            frames = sys._current_frames()
+            for thread_id in list(self.threads):
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def dump(self, path: str):
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class ProfileSession:
+    """Jedna sesja: cel, tryb, ile wywołań zostało"""
+
+    def __init__(self, target: str, count: int, mode: str, timeout: float, restore):
+        self.target = target
+        self.count = count
+        self.remaining = count
+        self.mode = mode
+        self.timeout = timeout
+        self.restore = restore        # przywraca oryginalną funkcję
+        self.started_at = datetime.utcnow()
+        self.elapsed = 0.0
+        self.calls = 0                # wywołania profilowane (zakończone)
+        self.active = 0               # wywołania profilowane w toku
+        self.finished = False
+        self.lock = threading.Lock()
+        self.timer = None
+        if mode == 'cprofile':
+            self.profiler = cProfile.Profile()
+        else:
+            self.profiler = StackSampler()
+
+    def to_dict(self):
+        return {
+            'target': self.target,
+            'mode': self.mode,
+            'count': self.count,
+            'remaining': self.remaining,
+            'timeout': self.timeout,
+            'started_at': self.started_at.isoformat()
+        }
+
+
+class ProfilerManager:
+    """Uzbraja i rozbraja profilowanie ingestu i endpointów aplikacji"""
+
+    def __init__(self, app, output_dir: str = PROFILE_DIR):
+        self.app = app
+        self.output_dir = output_dir
+        self.session = None
+        self.results = []
+        self._lock = threading.Lock()
+
+    # ---- uzbrajanie ----
+
+    def profile_ingest(self, count: int, mode: str = 'cprofile',
+                       timeout: float = PROFILE_TIMEOUT) -> ProfileSession:
+        """Profiluje następne `count` wiadomości MQTT"""
+        subscriber = self.app.extensions.get('mqtt_subscriber')
+        if subscriber is None:
+            raise ValueError('MQTT subscriber is not running')
+
+        original = subscriber._process_message
+
+        # Wątek zapisu wywołuje subscriber._process_message - podmiana na instancji
+        def install(wrapper):
+            subscriber._process_message = wrapper
+
+        def restore():
+            subscriber._process_message = original
+
+        return self._start('ingest', original, install, restore, count, mode, timeout)
+
+    def profile_route(self, endpoint: str, count: int, mode: str = 'cprofile',
+                      timeout: float = PROFILE_TIMEOUT) -> ProfileSession:
+        """Profiluje następne `count` żądań do endpointu (np. 'api.get_weather_history')"""
+        view_functions = self.app.view_functions
+        if endpoint not in view_functions:
+            raise ValueError(f'Unknown endpoint: {endpoint}')
+
+        original = view_functions[endpoint]
+
+        def install(wrapper):
+            view_functions[endpoint] = wrapper
+
+        def restore():
+            view_functions[endpoint] = original
+
+        return self._start(endpoint, original, install, restore, count, mode, timeout)
+
+    def _start(self, target, original, install, restore, count, mode, timeout):
+        if mode not in MODES:
+            raise ValueError(f'Invalid mode. Must be one of: {list(MODES)}')
+        if count <= 0:
+            raise ValueError('count must be positive')
+        if not (timeout > 0 and math.isfinite(timeout)):
+            raise ValueError('timeout must be a positive number of seconds')
+
+        with self._lock:
+            if self.session is not None:
+                raise RuntimeError(f'Profiling already in progress: {self.session.target}')
+            session = self.session = ProfileSession(target, count, mode, timeout, restore)
+
+        @wraps(original)
+        def wrapper(*args, **kwargs):
+            with session.lock:
+                if session.remaining <= 0:
+                    return original(*args, **kwargs)
+                session.remaining -= 1
+                session.active += 1
+                if session.remaining == 0:
+                    restore()
+
+            started = time.perf_counter()
+            session.profiler.enable()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                session.profiler.disable()
+                with session.lock:
+                    session.elapsed += time.perf_counter() - started
+                    session.calls += 1
+                    session.active -= 1
+                    done = session.remaining == 0 and not session.active
+                if done:
+                    self._finish(session)
+
+        session.timer = threading.Timer(timeout, self._stop_session, args=(session,))
+        session.timer.daemon = True
+        install(wrapper)
+        session.timer.start()
+        print(f"Profiling next {count} call(s) of {target} ({mode}, timeout {timeout:g}s)")
+        return session
+
+    def stop(self):
+        """Kończy bieżącą sesję przed czasem; zwraca ją albo None, gdy żadna nie trwa"""
+        session = self.session
+        if session is None:
+            return None
+        self._stop_session(session)
+        return session
+
+    def _stop_session(self, session: ProfileSession):
+        """Przywraca oryginalną funkcję i zapisuje profil częściowy"""
+        with session.lock:
+            if session.remaining > 0:
+                session.remaining = 0
+                session.restore()
+            # Wywołania w toku zapisze ostatnie z nich
+            idle = not session.active
+        if idle:
+            self._finish(session)
+
+    # ---- wyniki ----
+
+    def _finish(self, session: ProfileSession):
+        with session.lock:
+            if session.finished:
+                return
+            session.finished = True
+        session.timer.cancel()
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        stamp = session.started_at.strftime('%Y%m%d-%H%M%S-%f')
+        name = f"{session.target.replace('.', '_')}-{stamp}"
+
+        if session.mode == 'cprofile':
+            path = os.path.join(self.output_dir, f"{name}.pstats")
+            session.profiler.dump_stats(path)
+        else:
+            session.profiler.stop()
+            path = os.path.join(self.output_dir, f"{name}.collapsed")
+            session.profiler.dump(path)
+
+        result = dict(session.to_dict(), file=os.path.basename(path),
+                      calls=session.calls,
+                      total_seconds=round(session.elapsed, 6),
+                      finished_at=datetime.utcnow().isoformat())
+        with self._lock:
+            self.results.append(result)
+            self.session = None
+        print(f"Profile saved: {path}")
+
+    def status(self) -> dict:
+        return {
+            'active': self.session.to_dict() if self.session else None,
+            'results': list(self.results),
+            'output_dir': os.path.abspath(self.output_dir)
+        }
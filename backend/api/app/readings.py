@@ -0,0 +1,125 @@
+"""
+Lekkie rekordy odczytów pogodowych
+Używane na ścieżce ingest -> alerty zamiast pełnych obiektów ORM;
+zapis do bazy idzie przez Core insert (executemany)
+"""
+
+from datetime import datetime
+
+from sqlalchemy import insert, select, update
+
+from app import db
+from app.models import City, WeatherReading
+
+
+# Pola odczytu w kolejności kolumn tabeli weather_readings
+READING_FIELDS = ('city', 'temperature', 'humidity', 'pressure',
+                  'wind_speed', 'weather', 'timestamp')
+
+# Metryki liczbowe, po których można definiować reguły alertów
+METRICS = ('temperature', 'humidity', 'pressure', 'wind_speed')
+
+
+class ReadingRecord:
+    """Kompaktowy odczyt pogodowy (bez stanu sesji SQLAlchemy)"""
+
+    __slots__ = READING_FIELDS + ('received_at',)
+
+    def __init__(self, city, temperature, humidity, pressure, wind_speed,
+                 weather, timestamp, received_at=None):
+        self.city = city
+        self.temperature = temperature
+        self.humidity = humidity
+        self.pressure = pressure
+        self.wind_speed = wind_speed
+        self.weather = weather
+        self.timestamp = timestamp
+        self.received_at = received_at
+
+    @classmethod
+    def from_payload(cls, payload: dict) -> 'ReadingRecord':
+        """Tworzy rekord z wiadomości MQTT (KeyError gdy brakuje pola)"""
+        return cls(
+            payload['city'],
+            payload['temperature'],
+            payload['humidity'],
+            payload['pressure'],
+            payload['wind_speed'],
+            payload['weather'],
+            payload['timestamp']
+        )
+
+    def to_row(self) -> dict:
+        """Zwraca słownik parametrów dla insert(weather_readings)"""
+        return {
+            'city': self.city,
+            'temperature': self.temperature,
+            'humidity': self.humidity,
+            'pressure': self.pressure,
+            'wind_speed': self.wind_speed,
+            'weather': self.weather,
+            'timestamp': self.timestamp,
+            'received_at': self.received_at
+        }
+
+    def __repr__(self):
+        return f"ReadingRecord(city={self.city!r}, timestamp={self.timestamp!r})"
+
+
+def insert_ignore(table, index_elements):
+    """INSERT pomijający wiersze, które naruszyłyby unikalny indeks index_elements"""
+    dialect = db.engine.dialect.name
+    if dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    elif dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        return insert(table).prefix_with('IGNORE')  # MySQL / MariaDB
+    return dialect_insert(table).on_conflict_do_nothing(index_elements=index_elements)
+
+
+def insert_readings(records, commit=True, update_latest=True) -> int:
+    """
+    Zapisuje odczyty jednym Core insert (executemany), bez unit-of-work ORM.
+    Odczyty już zapisane (ten sam city i timestamp, np. ponowne dostarczenie
+    wiadomości QoS 1) są pomijane - zwraca liczbę faktycznie dodanych wierszy.
+    Ustawia received_at na rekordach, które go nie mają.
+    update_latest=False pomija aktualizację cities.latest_reading_id
+    (import zbiorczy robi ją raz na końcu).
+    """
+    if not records:
+        return 0
+
+    now = datetime.utcnow()
+    rows = []
+    for record in records:
+        if record.received_at is None:
+            record.received_at = now
+        rows.append(record.to_row())
+
+    # Odczyty już zapisane (unikalne city, timestamp) są pomijane
+    statement = insert_ignore(WeatherReading.__table__, ['city', 'timestamp'])
+    inserted = db.session.execute(statement, rows).rowcount
+    if update_latest and inserted:
+        update_latest_readings({record.city for record in records})
+    if commit:
+        db.session.commit()
+    return inserted
+
+
+def update_latest_readings(cities=None):
+    """
+    Ustawia cities.latest_reading_id na najnowszy (po timestamp) odczyt miasta.
+    Korzysta z indeksu (city, timestamp); bez listy miast aktualizuje wszystkie.
+    """
+    latest = (
+        select(WeatherReading.id)
+        .where(WeatherReading.city == City.name)
+        .order_by(WeatherReading.timestamp.desc(), WeatherReading.id.desc())
+        .limit(1)
+        .scalar_subquery()
+    )
+    statement = update(City).values(latest_reading_id=latest)
+    if cities is not None:
+        statement = statement.where(City.name.in_(list(cities)))
+    db.session.execute(statement, execution_options={'synchronize_session': False})
@@ -3,11 +3,20 @@ REST API ROUTES
 Provides endpoints for weather data and alerts
 """
 
-from flask import Blueprint, jsonify, request
+import hmac
+import os
+
+from flask import Blueprint, current_app, jsonify, request, send_from_directory
 from app import db
-from app.models import WeatherReading, Alert, AlertRule
+from app.models import WeatherReading, Alert, AlertRule, City
 from app.alerts import AlertEngine
-from sqlalchemy import desc
+from app.cities import import_cities, normalize_city, parse_city_import
+from app.encoding import columnar_readings, encoded_json_response
+from app.geo import city_index
+from app.profiling import PROFILE_TIMEOUT
+from app.readings import METRICS
+from app.sketches import DAY, merged_sketch
+from sqlalchemy import desc, func, select, union_all
 
 api_bp = Blueprint('api', __name__)
 alert_engine = AlertEngine()
@@ -21,26 +30,20 @@ def get_current_weather():
     city = request.args.get('city')
     
     if city:
-        reading = WeatherReading.query.filter_by(city=city).order_by(
-            desc(WeatherReading.id)
-        ).first()
+        # Najnowszy po czasie pomiaru - import historii dopisuje starsze odczyty z wyższym id
+        readings = _latest_readings([city])
 
-        if not reading:
+        if not readings:
             return jsonify({'error': f'No data found for city {city}'}), 404
 
-        return jsonify(reading.to_dict())
+        return jsonify(readings[0].to_dict())
 
     else:
-        all_readings = WeatherReading.query.order_by(desc(WeatherReading.id)).all()
-        cities_seen = set()
-        latest_readings = []
-        
-        for reading in all_readings:
-            if reading.city not in cities_seen:
-                cities_seen.add(reading.city)
-                latest_readings.append(reading.to_dict())
+        # Najnowszy odczyt każdego miasta z odczytami - rejestr jednym joinem
+        latest_readings = _latest_readings()
+        latest_readings.sort(key=lambda r: r.id, reverse=True)
 
-        return jsonify(latest_readings)
+        return jsonify([reading.to_dict() for reading in latest_readings])
 
 
 @api_bp.route('/weather/history', methods=['GET'])
@@ -52,6 +55,20 @@ def get_weather_history():
     if not city:
         return jsonify({'error': 'City parameter is required'}), 400
     
+    if request.args.get('format') == 'columnar':
+        # Kolumny bez obiektów ORM, format kolumnowy i kompresja
+        rows = db.session.execute(
+            select(WeatherReading.id, WeatherReading.temperature,
+                   WeatherReading.humidity, WeatherReading.pressure,
+                   WeatherReading.wind_speed, WeatherReading.weather,
+                   WeatherReading.timestamp, WeatherReading.received_at)
+            .where(WeatherReading.city == city)
+            .order_by(desc(WeatherReading.timestamp))
+            .limit(limit)
+        ).all()
+        payload = dict(columnar_readings(rows), city=city, format='columnar')
+        return encoded_json_response(payload, request.headers.get('Accept-Encoding'))
+    
     readings = WeatherReading.query.filter_by(city=city)\
         .order_by(desc(WeatherReading.timestamp))\
         .limit(limit)\
@@ -60,6 +77,243 @@ def get_weather_history():
     return jsonify([r.to_dict() for r in readings])
 
 
+# Maksymalna liczba miast w jednym zapytaniu zbiorczym
+MAX_BATCH_CITIES = 500
+
+
+def _requested_cities():
+    """Lista miast z ?cities=a,b,c i/lub powtórzonych ?city=..."""
+    cities = request.args.getlist('city')
+    for value in request.args.getlist('cities'):
+        cities.extend(value.split(','))
+    return list(dict.fromkeys(c.strip() for c in cities if c.strip()))
+
+
+# SQLite ogranicza liczbę członów UNION ALL (domyślnie 500)
+_UNION_CHUNK = 200
+
+
+def _recent_readings(cities, limit, start=None, end=None):
+    """
+    Do `limit` najnowszych odczytów każdego miasta (opcjonalnie w zakresie
+    start/end), posortowane po mieście i czasie malejąco. Każde miasto to
+    osobne zapytanie z LIMIT po indeksie (city, timestamp), złączone UNION ALL -
+    czytane są tylko potrzebne wiersze, a nie cała historia miast
+    """
+    readings = []
+    for offset in range(0, len(cities), _UNION_CHUNK):
+        parts = []
+        for city in cities[offset:offset + _UNION_CHUNK]:
+            query = select(WeatherReading.id).where(WeatherReading.city == city)
+            if start is not None:
+                query = query.where(WeatherReading.timestamp >= start)
+            if end is not None:
+                query = query.where(WeatherReading.timestamp <= end)
+            query = query.order_by(desc(WeatherReading.timestamp)).limit(limit).subquery()
+            parts.append(select(query.c.id))
+
+        ids = union_all(*parts) if len(parts) > 1 else parts[0]
+        readings.extend(db.session.execute(
+            select(WeatherReading).where(WeatherReading.id.in_(ids))
+            .order_by(WeatherReading.city, desc(WeatherReading.timestamp))
+        ).scalars())
+    return readings
+
+
+def _reading_cities():
+    """
+    Miasta, które mają odczyty - skok po indeksie (city, timestamp) od miasta
+    do następnego (rekurencyjne CTE), zamiast skanu wszystkich wierszy przez DISTINCT
+    """
+    table = WeatherReading.__table__
+    cities = select(func.min(table.c.city).label('city')).cte('reading_cities', recursive=True)
+    cities = cities.union_all(
+        select(select(func.min(table.c.city)).where(table.c.city > cities.c.city).scalar_subquery())
+        .where(cities.c.city.is_not(None))
+    )
+    return db.session.execute(
+        select(cities.c.city).where(cities.c.city.is_not(None))
+    ).scalars().all()
+
+
+def _latest_readings(cities=None):
+    """
+    Najnowsze odczyty miast: z rejestru przez cities.latest_reading_id
+    (jeden join po kluczu głównym; miasto bez odczytów ma tam NULL), a dla miast
+    spoza rejestru (np. usuniętych z niego albo nigdy niezapisanych) przez
+    wyszukanie po indeksie (city, timestamp). Bez listy - wszystkie miasta z odczytami.
+    """
+    query = select(City.name, WeatherReading).outerjoin(
+        WeatherReading, City.latest_reading_id == WeatherReading.id
+    )
+    if cities is not None:
+        query = query.where(City.name.in_(cities))
+    registered = db.session.execute(query).all()
+    by_city = {name: reading for name, reading in registered if reading is not None}
+
+    if cities is None:
+        cities = _reading_cities()
+    known = {name for name, _ in registered}
+    missing = [city for city in cities if city not in known]
+    if missing:
+        by_city.update((reading.city, reading) for reading in _recent_readings(missing, 1))
+    return [by_city[city] for city in cities if city in by_city]
+
+
+@api_bp.route('/weather/current/batch', methods=['GET'])
+def get_current_weather_batch():
+    """Najnowsze odczyty wielu miast (?cities=a,b,c) jednym zapytaniem"""
+    cities = _requested_cities()
+    
+    if not cities:
+        return jsonify({'error': 'cities parameter is required'}), 400
+    if len(cities) > MAX_BATCH_CITIES:
+        return jsonify({'error': f'Too many cities (max {MAX_BATCH_CITIES})'}), 400
+    
+    readings = _latest_readings(cities)
+    by_city = {reading.city: reading.to_dict() for reading in readings}
+    
+    return jsonify({
+        'cities': by_city,
+        'missing': [city for city in cities if city not in by_city]
+    })
+
+
+@api_bp.route('/weather/history/batch', methods=['GET'])
+def get_weather_history_batch():
+    """
+    Historia wielu miast w zakresie czasu (start/end jako unix timestamp),
+    z limitem odczytów na miasto - jedno zapytanie, wynik grupowany per miasto
+    """
+    cities = _requested_cities()
+    limit = request.args.get('limit', 100, type=int)
+    start = request.args.get('start', type=int)
+    end = request.args.get('end', type=int)
+    
+    if not cities:
+        return jsonify({'error': 'cities parameter is required'}), 400
+    if len(cities) > MAX_BATCH_CITIES:
+        return jsonify({'error': f'Too many cities (max {MAX_BATCH_CITIES})'}), 400
+    
+    readings = _recent_readings(cities, limit, start=start, end=end)
+    
+    history = {city: [] for city in cities}
+    for reading in readings:
+        history[reading.city].append(reading.to_dict())
+    
+    return jsonify({'cities': history})
+
+
+DEFAULT_QUANTILES = '0.5,0.9,0.95,0.99'
+
+
+@api_bp.route('/weather/percentiles', methods=['GET'])
+def get_weather_percentiles():
+    """
+    Przybliżone percentyle metryki dla listy miast i zakresu czasu
+    (start/end jako unix timestamp, zaokrąglane do pełnych dni UTC)
+    ze scalonych dziennych szkiców kwantyli - bez czytania odczytów
+    """
+    cities = _requested_cities()
+    metric = request.args.get('metric')
+    start = request.args.get('start', type=int)
+    end = request.args.get('end', type=int)
+    
+    if not cities:
+        return jsonify({'error': 'cities parameter is required'}), 400
+    if len(cities) > MAX_BATCH_CITIES:
+        return jsonify({'error': f'Too many cities (max {MAX_BATCH_CITIES})'}), 400
+    if metric not in METRICS:
+        return jsonify({'error': f'Invalid metric. Must be one of: {list(METRICS)}'}), 400
+    
+    try:
+        qs = [float(q) for q in request.args.get('q', DEFAULT_QUANTILES).split(',')]
+    except ValueError:
+        return jsonify({'error': 'q must be a comma-separated list of numbers'}), 400
+    if not all(0 <= q <= 1 for q in qs):
+        return jsonify({'error': 'q values must be between 0 and 1'}), 400
+    
+    sketch, days = merged_sketch(cities, metric, start, end)
+    if not sketch.count:
+        return jsonify({'error': 'No data found for the given cities and range'}), 404
+    
+    values = sketch.quantiles(qs)
+    return jsonify({
+        'metric': metric,
+        'cities': cities,
+        'start': start // DAY * DAY if start is not None else None,
+        'end': (end // DAY + 1) * DAY - 1 if end is not None else None,
+        'count': sketch.count,
+        'sketches': days,
+        'quantiles': {str(q): round(value, 2) for q, value in zip(qs, values)},
+        'rank_error': round(sketch.rank_error, 4)
+    })
+
+
+def _aggregate_readings(readings):
+    """Średnia, minimum i maksimum metryk dla listy odczytów"""
+    aggregates = {}
+    for metric in METRICS:
+        values = [getattr(r, metric) for r in readings]
+        if values:
+            aggregates[metric] = {
+                'avg': sum(values) / len(values),
+                'min': min(values),
+                'max': max(values)
+            }
+    return aggregates
+
+
+def _spatial_response(city_names, distances=None):
+    readings = _latest_readings(city_names)
+
+    items = []
+    for reading in readings:
+        item = reading.to_dict()
+        if distances is not None:
+            item['distance_km'] = round(distances[reading.city], 3)
+        items.append(item)
+
+    response = {'cities': items, 'count': len(items), 'matched_cities': len(city_names)}
+    if request.args.get('aggregate', 'false').lower() == 'true':
+        response['aggregates'] = _aggregate_readings(readings)
+    return jsonify(response)
+
+
+@api_bp.route('/weather/nearby', methods=['GET'])
+def get_weather_nearby():
+    """Najnowsze odczyty miast w promieniu radius_km od punktu (lat, lon)"""
+    lat = request.args.get('lat', type=float)
+    lon = request.args.get('lon', type=float)
+    radius_km = request.args.get('radius_km', 50, type=float)
+    
+    if lat is None or lon is None:
+        return jsonify({'error': 'lat and lon parameters are required'}), 400
+    if not -90 <= lat <= 90 or not -180 <= lon <= 180 or radius_km <= 0:
+        return jsonify({'error': 'Invalid lat, lon or radius_km'}), 400
+    
+    matches = city_index.get().within_radius(lat, lon, radius_km)
+    return _spatial_response([name for name, _ in matches], dict(matches))
+
+
+@api_bp.route('/weather/bbox', methods=['GET'])
+def get_weather_bbox():
+    """Najnowsze odczyty miast w prostokącie (min_lon > max_lon = przez 180°)"""
+    try:
+        min_lat = float(request.args['min_lat'])
+        min_lon = float(request.args['min_lon'])
+        max_lat = float(request.args['max_lat'])
+        max_lon = float(request.args['max_lon'])
+    except (KeyError, ValueError):
+        return jsonify({'error': 'min_lat, min_lon, max_lat and max_lon are required'}), 400
+    
+    if min_lat > max_lat:
+        return jsonify({'error': 'min_lat must not be greater than max_lat'}), 400
+    
+    names = city_index.get().within_bbox(min_lat, min_lon, max_lat, max_lon)
+    return _spatial_response(names)
+
+
 # ============ ALERT ENDPOINTS ============
 
 @api_bp.route('/alerts', methods=['GET'])
@@ -67,6 +321,7 @@ def get_alerts():
     """Pobiera alerty"""
     city = request.args.get('city')
     unread_only = request.args.get('unread_only', 'false').lower() == 'true'
+    open_only = request.args.get('open_only', 'false').lower() == 'true'
     limit = request.args.get('limit', 50, type=int)
     
     query = Alert.query
@@ -77,6 +332,9 @@ def get_alerts():
     if unread_only:
         query = query.filter_by(is_read=False)
     
+    if open_only:
+        query = query.filter(Alert.closed_at.is_(None))
+    
     alerts = query.order_by(desc(Alert.created_at)).limit(limit).all()
     
     return jsonify({
@@ -145,7 +403,7 @@ def create_alert_rule():
             return jsonify({'error': f'Missing required field: {field}'}), 400
     
     # Sprawdź poprawność operatora
-    valid_operators = ['>', '<', '>=', '<=', '==']
+    valid_operators = ['>', '<', '>=', '<=', '==', 'anomaly']
     if data['operator'] not in valid_operators:
         return jsonify({'error': f'Invalid operator. Must be one of: {valid_operators}'}), 400
     
@@ -190,7 +448,7 @@ def update_alert_rule(rule_id):
     if 'is_active' in data:
         rule.is_active = data['is_active']
     if 'operator' in data:
-        valid_operators = ['>', '<', '>=', '<=', '==']
+        valid_operators = ['>', '<', '>=', '<=', '==', 'anomaly']
         if data['operator'] not in valid_operators:
             return jsonify({'error': f'Invalid operator'}), 400
         rule.operator = data['operator']
@@ -234,13 +492,227 @@ def toggle_alert_rule(rule_id):
     return jsonify(rule.to_dict())
 
 
+# ============ CITY REGISTRY ENDPOINTS ============
+
+@api_bp.route('/cities', methods=['GET'])
+def get_cities():
+    """Pobiera rejestr miast"""
+    active_only = request.args.get('active_only', 'false').lower() == 'true'
+    
+    query = City.query
+    
+    if active_only:
+        query = query.filter_by(is_active=True)
+    
+    cities = query.order_by(City.name).all()
+    
+    return jsonify([city.to_dict() for city in cities])
+
+
+@api_bp.route('/cities', methods=['POST'])
+def create_city():
+    """Dodaje miasto (lub aktualizuje istniejące) i tworzy domyślne reguły"""
+    data = request.json or {}
+    
+    try:
+        city = normalize_city(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    seed_rules = request.args.get('seed_rules', 'true').lower() == 'true'
+    
+    try:
+        result = import_cities([city], seed_rules=seed_rules)
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+    
+    city = City.query.filter_by(name=city['name']).first()
+    return jsonify(dict(city.to_dict(), **result)), 201 if result['created'] else 200
+
+
+@api_bp.route('/cities/import', methods=['POST'])
+def import_cities_bulk():
+    """
+    Import zbiorczy miast z CSV (text/csv lub plik 'file') albo JSON,
+    z upsertem domyślnych reguł dla aktywnych miast
+    """
+    upload = request.files.get('file')
+    if upload:
+        text = upload.read().decode('utf-8-sig')
+        fmt = 'csv' if upload.filename.lower().endswith('.csv') else 'json'
+    else:
+        text = request.get_data(as_text=True)
+        fmt = 'csv' if 'csv' in (request.content_type or '') else 'json'
+    fmt = request.args.get('format', fmt)
+    
+    try:
+        cities = parse_city_import(text, fmt)
+    except (ValueError, KeyError, AttributeError) as e:
+        return jsonify({'error': f'Invalid import data: {e}'}), 400
+    
+    seed_rules = request.args.get('seed_rules', 'true').lower() == 'true'
+    
+    try:
+        result = import_cities(cities, seed_rules=seed_rules)
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+    
+    return jsonify(dict(result, success=True, total=len(cities)))
+
+
+@api_bp.route('/cities/<int:city_id>', methods=['PUT'])
+def update_city(city_id):
+    """Aktualizuje miasto (współrzędne, aktywność)"""
+    city = City.query.get(city_id)
+    
+    if not city:
+        return jsonify({'error': 'City not found'}), 404
+    
+    data = request.json or {}
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Expected a JSON object'}), 400
+    
+    # Ta sama walidacja co przy dodawaniu i imporcie; pola niepodane zostają
+    try:
+        changes = normalize_city(dict(data, name=city.name))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    for field in ('lat', 'lon', 'is_active'):
+        if changes[field] is not None:
+            setattr(city, field, changes[field])
+    
+    try:
+        db.session.commit()
+        return jsonify(city.to_dict())
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+
+@api_bp.route('/cities/<int:city_id>', methods=['DELETE'])
+def delete_city(city_id):
+    """Usuwa miasto z rejestru (odczyty i reguły zostają)"""
+    city = City.query.get(city_id)
+    
+    if not city:
+        return jsonify({'error': 'City not found'}), 404
+    
+    try:
+        db.session.delete(city)
+        db.session.commit()
+        return jsonify({'success': True, 'message': 'City deleted'})
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+
 # ============ UTILITY ENDPOINTS ============
 
 @api_bp.route('/health', methods=['GET'])
+@api_bp.route('/health/live', methods=['GET'])
 def health_check():
+    """Liveness - proces działa i obsługuje HTTP"""
     return jsonify({'status': 'ok', 'service': 'weather-api'})
 
 
+@api_bp.route('/health/ready', methods=['GET'])
+def readiness_check():
+    """Readiness - schemat gotowy i subskrybent MQTT połączony"""
+    schema_ready = current_app.extensions.get('schema_ready', False)
+    # None = aplikacja działa bez subskrybenta (np. skrypty, testy)
+    mqtt_connected = None
+    if 'mqtt_subscriber' in current_app.extensions:
+        subscriber = current_app.extensions['mqtt_subscriber']
+        mqtt_connected = bool(subscriber and subscriber.mqtt_connected)
+
+    ready = schema_ready and mqtt_connected is not False
+    return jsonify({
+        'status': 'ready' if ready else 'starting',
+        'schema_ready': schema_ready,
+        'mqtt_connected': mqtt_connected
+    }), 200 if ready else 503
+
+
+# ============ ADMIN / PROFILING ============
+
+def _admin_authorized():
+    """
+    Wymaga nagłówka X-Admin-Token zgodnego z ADMIN_TOKEN;
+    bez ustawionego ADMIN_TOKEN endpointy administracyjne są wyłączone
+    """
+    token = os.getenv('ADMIN_TOKEN')
+    if not token:
+        return False
+    return hmac.compare_digest(request.headers.get('X-Admin-Token', ''), token)
+
+
+@api_bp.route('/admin/profile', methods=['GET'])
+def get_profile_status():
+    """Stan profilowania i lista zapisanych profili"""
+    if not _admin_authorized():
+        return jsonify({'error': 'Unauthorized'}), 401
+    return jsonify(current_app.extensions['profiler'].status())
+
+
+@api_bp.route('/admin/profile', methods=['POST'])
+def start_profile():
+    """
+    Profiluje następne N wywołań.
+    Body: {"target": "ingest"} albo {"target": "route", "endpoint": "api.get_weather_history"},
+    opcjonalnie "count" (domyślnie 100), "mode" ("cprofile" lub "sample")
+    i "timeout" w sekundach (domyślnie PROFILE_TIMEOUT) - po nim sesja kończy się
+    z profilem częściowym
+    """
+    if not _admin_authorized():
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    data = request.get_json(silent=True) or {}
+    profiler = current_app.extensions['profiler']
+    target = data.get('target', 'ingest')
+    mode = data.get('mode', 'cprofile')
+
+    try:
+        count = int(data.get('count', 100))
+        timeout = float(data.get('timeout', PROFILE_TIMEOUT))
+        if target == 'ingest':
+            session = profiler.profile_ingest(count, mode, timeout)
+        elif target == 'route':
+            if not data.get('endpoint'):
+                return jsonify({'error': 'Missing required field: endpoint'}), 400
+            session = profiler.profile_route(data['endpoint'], count, mode, timeout)
+        else:
+            return jsonify({'error': "Invalid target. Must be 'ingest' or 'route'"}), 400
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except RuntimeError as e:
+        return jsonify({'error': str(e)}), 409
+
+    return jsonify({'success': True, 'session': session.to_dict()}), 202
+
+
+@api_bp.route('/admin/profile', methods=['DELETE'])
+def stop_profile():
+    """Kończy bieżącą sesję przed czasem - przywraca funkcję i zapisuje profil częściowy"""
+    if not _admin_authorized():
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    session = current_app.extensions['profiler'].stop()
+    if session is None:
+        return jsonify({'error': 'No profiling in progress'}), 404
+    return jsonify({'success': True, 'session': session.to_dict()})
+
+
+@api_bp.route('/admin/profile/<path:filename>', methods=['GET'])
+def download_profile(filename):
+    """Pobiera zapisany plik profilu (.pstats / .collapsed)"""
+    if not _admin_authorized():
+        return jsonify({'error': 'Unauthorized'}), 401
+    profiler = current_app.extensions['profiler']
+    return send_from_directory(os.path.abspath(profiler.output_dir), filename, as_attachment=True)
+
+
 @api_bp.route('/stats', methods=['GET'])
 def get_stats():
     """Pobiera statystyki systemu"""
@@ -0,0 +1,217 @@
+"""
+Skompilowane reguły alertów
+Aktywne reguły miasta są grupowane per metryka i sortowane po progu,
+dzięki czemu odczyt znajduje przekroczone reguły bisekcją
+w O(log R + k) zamiast sprawdzać każdą regułę po kolei
+"""
+
+import os
+import time
+from bisect import bisect_left, bisect_right
+
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import Session, object_session
+
+from app import db
+from app.models import AlertRule
+from app.readings import METRICS
+
+
+KELVIN_OFFSET = 273.15
+
+UNIT_MAP = {
+    'temperature': '°C',
+    'humidity': '%',
+    'pressure': 'hPa',
+    'wind_speed': 'm/s'
+}
+
+CONDITION_NAMES = {
+    'temperature': 'Temperatura',
+    'humidity': 'Wilgotność',
+    'pressure': 'Ciśnienie',
+    'wind_speed': 'Prędkość wiatru'
+}
+
+# Operatory obsługiwane przez indeks progów
+THRESHOLD_OPERATORS = ('>', '<', '>=', '<=', '==')
+
+# Reguła anomalii: próg to limit z-score względem wyuczonej normy
+# (obsługuje ją AnomalyDetector, nie indeks progów)
+ANOMALY_OPERATOR = 'anomaly'
+
+# Jak długo skompilowane reguły są ważne bez sygnału o zmianie
+# (zmiany robione poza tym procesem, np. przez init_alerts.py)
+RULE_CACHE_TTL = float(os.getenv('RULE_CACHE_TTL', 60))
+
+
+class CompiledRule:
+    """Reguła z gotowym szablonem wiadomości"""
+
+    __slots__ = ('id', 'name', 'condition_type', 'operator', 'threshold',
+                 'message_prefix', 'message_suffix')
+
+    def __init__(self, rule_id, name, city, condition_type, operator, threshold):
+        self.id = rule_id
+        self.name = name
+        self.condition_type = condition_type
+        self.operator = operator
+        self.threshold = threshold
+
+        unit = UNIT_MAP.get(condition_type, '')
+        condition_name = CONDITION_NAMES.get(condition_type, condition_type)
+        self.message_prefix = f"{name}: {condition_name} w {city} wynosi "
+        self.message_suffix = f"{unit}, co przekracza próg {threshold}{unit}"
+
+    def message(self, value: float) -> str:
+        return f"{self.message_prefix}{value:.1f}{self.message_suffix}"
+
+
+class MetricRules:
+    """Reguły jednej metryki posortowane po progu, osobno dla każdego operatora"""
+
+    __slots__ = ('gt', 'ge', 'lt', 'le', 'eq')
+
+    def __init__(self):
+        # (posortowane progi, reguły w tej samej kolejności)
+        self.gt = ([], [])
+        self.ge = ([], [])
+        self.lt = ([], [])
+        self.le = ([], [])
+        self.eq = {}
+
+    def add(self, rule: CompiledRule):
+        if rule.operator == '==':
+            self.eq.setdefault(rule.threshold, []).append(rule)
+            return
+
+        thresholds, rules = {
+            '>': self.gt, '>=': self.ge, '<': self.lt, '<=': self.le
+        }[rule.operator]
+        index = bisect_right(thresholds, rule.threshold)
+        thresholds.insert(index, rule.threshold)
+        rules.insert(index, rule)
+
+    def crossed(self, value: float) -> list:
+        """Zwraca reguły, których warunek jest spełniony dla wartości"""
+        result = []
+
+        thresholds, rules = self.gt          # próg < wartość
+        if thresholds:
+            result.extend(rules[:bisect_left(thresholds, value)])
+        thresholds, rules = self.ge          # próg <= wartość
+        if thresholds:
+            result.extend(rules[:bisect_right(thresholds, value)])
+        thresholds, rules = self.lt          # próg > wartość
+        if thresholds:
+            result.extend(rules[bisect_right(thresholds, value):])
+        thresholds, rules = self.le          # próg >= wartość
+        if thresholds:
+            result.extend(rules[bisect_left(thresholds, value):])
+        if self.eq:
+            result.extend(self.eq.get(value, ()))
+
+        return result
+
+
+class CityRules:
+    """Wszystkie aktywne reguły miasta, pogrupowane per metryka"""
+
+    __slots__ = ('city', 'metrics', 'anomaly', 'compiled_at')
+
+    def __init__(self, city: str):
+        self.city = city
+        self.metrics = {}
+        self.anomaly = {}      # metryka -> [reguły anomalii] (np. różne progi z-score)
+        self.compiled_at = time.monotonic()
+
+    def add(self, rule: CompiledRule):
+        metric_rules = self.metrics.get(rule.condition_type)
+        if metric_rules is None:
+            metric_rules = self.metrics[rule.condition_type] = MetricRules()
+        metric_rules.add(rule)
+
+    def crossed(self, reading) -> list:
+        """Zwraca listę (reguła, wartość) przekroczonych przez odczyt"""
+        result = []
+        for metric, metric_rules in self.metrics.items():
+            value = getattr(reading, metric)
+            if metric == 'temperature':
+                value = value - KELVIN_OFFSET
+            for rule in metric_rules.crossed(value):
+                result.append((rule, value))
+        return result
+
+
+def compile_city_rules(city: str) -> CityRules:
+    """Ładuje aktywne reguły miasta jednym zapytaniem (bez obiektów ORM)"""
+    rows = db.session.execute(
+        select(AlertRule.id, AlertRule.name, AlertRule.condition_type,
+               AlertRule.operator, AlertRule.threshold)
+        .where(AlertRule.city == city, AlertRule.is_active.is_(True))
+    )
+
+    city_rules = CityRules(city)
+    for rule_id, name, condition_type, operator, threshold in rows:
+        if condition_type not in METRICS:
+            continue
+        rule = CompiledRule(rule_id, name, city, condition_type, operator, threshold)
+        if operator == ANOMALY_OPERATOR:
+            city_rules.anomaly.setdefault(condition_type, []).append(rule)
+        elif operator in THRESHOLD_OPERATORS:
+            city_rules.add(rule)
+    return city_rules
+
+
+class RuleCache:
+    """Cache skompilowanych reguł per miasto"""
+
+    def __init__(self, ttl: float = RULE_CACHE_TTL):
+        self.ttl = ttl
+        self._cities = {}
+
+    def get(self, city: str) -> CityRules:
+        city_rules = self._cities.get(city)
+        if city_rules is None or time.monotonic() - city_rules.compiled_at > self.ttl:
+            city_rules = self._cities[city] = compile_city_rules(city)
+        return city_rules
+
+    def invalidate(self, city: str = None):
+        if city is None:
+            self._cities.clear()
+        else:
+            self._cities.pop(city, None)
+
+
+# Wspólny cache dla wszystkich instancji AlertEngine w procesie
+rule_cache = RuleCache()
+
+
+# Zmiany reguł zbierane przy flush, cache unieważniany dopiero po commit -
+# inaczej wątek MQTT mógłby w międzyczasie skompilować stare reguły na cały TTL
+_PENDING_KEY = 'rule_cache_cities'
+
+
+@event.listens_for(AlertRule, 'after_insert')
+@event.listens_for(AlertRule, 'after_update')
+@event.listens_for(AlertRule, 'after_delete')
+def _collect_changed_rule(mapper, connection, target):
+    session = object_session(target)
+    if session is None:
+        rule_cache.invalidate(target.city)
+        return
+    cities = session.info.setdefault(_PENDING_KEY, set())
+    cities.add(target.city)
+    # Reguła przeniesiona do innego miasta - stare miasto też
+    cities.update(inspect(target).attrs.city.history.deleted or ())
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_rule_cache(session):
+    for city in session.info.pop(_PENDING_KEY, ()):
+        rule_cache.invalidate(city)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_rule_changes(session, previous_transaction):
+    session.info.pop(_PENDING_KEY, None)
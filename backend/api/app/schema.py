@@ -0,0 +1,101 @@
+"""
+Schemat bazy danych
+Idempotentne tworzenie i uzupełnianie schematu - można wywoływać
+przy każdym starcie, także na istniejącej bazie
+"""
+
+from sqlalchemy import inspect, text
+
+from app import db
+
+
+def ensure_schema():
+    """
+    Tworzy brakujące tabele, dodaje brakujące kolumny i indeksy
+    w istniejących tabelach (db.create_all() tego nie robi)
+    """
+    engine = db.engine
+    existing_tables = set(inspect(engine).get_table_names())
+    db.create_all()
+
+    inspector = inspect(engine)
+    added = []
+
+    with engine.begin() as connection:
+        deduplicated = _deduplicate_readings(connection, inspector)
+
+        for table in db.metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                connection.execute(text(
+                    f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'
+                ))
+                added.append(f"{table.name}.{column.name}")
+
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+
+    if added:
+        print(f"Schema updated, added columns: {', '.join(added)}")
+        _backfill_columns(added)
+    created = [table.name for table in db.metadata.sorted_tables
+               if table.name not in existing_tables]
+    if created:
+        _backfill_tables(created)
+    if deduplicated:
+        # Usunięte duplikaty mogły być najnowszymi odczytami miast
+        from app.readings import update_latest_readings
+        update_latest_readings()
+        db.session.commit()
+    return added
+
+
+def _backfill_tables(created):
+    """Wypełnia nowo utworzone tabele (także w istniejącej bazie)"""
+    if 'cities' in created:
+        # Pusty rejestr = collector nie odpytuje żadnego miasta
+        from app.cities import ensure_default_cities
+        added = ensure_default_cities()
+        print(f"City registry initialized with {added} city(ies)")
+    if 'reading_sketches' in created and 'weather_readings' not in created:
+        from app.sketches import rebuild_sketches
+        saved = rebuild_sketches()
+        print(f"Built {saved} quantile sketch(es) from existing readings")
+
+
+def _deduplicate_readings(connection, inspector) -> int:
+    """
+    Przed założeniem unikalnego indeksu (city, timestamp) usuwa zdublowane
+    odczyty (zostaje ten o najmniejszym id) i zastępuje stary nieunikalny indeks
+    """
+    indexes = {index['name'] for index in inspector.get_indexes('weather_readings')}
+    if 'uq_weather_readings_city_timestamp' in indexes:
+        return 0
+
+    deleted = connection.execute(text(
+        'DELETE FROM weather_readings WHERE id NOT IN '
+        '(SELECT MIN(id) FROM weather_readings GROUP BY city, timestamp)'
+    )).rowcount
+    if 'ix_weather_readings_city_timestamp' in indexes:
+        connection.execute(text('DROP INDEX ix_weather_readings_city_timestamp'))
+    if deleted:
+        print(f"Removed {deleted} duplicate weather reading(s)")
+    return deleted
+
+
+def _backfill_columns(added):
+    """Wypełnia dane w kolumnach dodanych do istniejących tabel"""
+    if 'alerts.closed_at' in added:
+        # Alerty sprzed epizodów traktujemy jako zamknięte, jednorazowe epizody
+        db.session.execute(text(
+            'UPDATE alerts SET closed_at = created_at, last_seen = created_at, '
+            'peak_value = value, trigger_count = 1 WHERE closed_at IS NULL'
+        ))
+        db.session.commit()
+    if 'cities.latest_reading_id' in added:
+        from app.readings import update_latest_readings
+        update_latest_readings()
+        db.session.commit()
@@ -0,0 +1,361 @@
+"""
+Quantile Sketches
+Strumieniowe, scalalne szkice kwantyli (KLL) per (miasto, metryka, dzień UTC).
+Szkic trzyma O(k) wartości niezależnie od liczby odczytów; scalenie dowolnie
+wielu szkiców daje przybliżone percentyle z ograniczonym błędem rangi
+(dla k=200 około 1.3% przy 99% ufności, dokładnie dopóki szkic nie był kompaktowany).
+"""
+
+import math
+import os
+import random
+import struct
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from datetime import datetime
+
+from sqlalchemy import select, update
+
+from app import db
+from app.models import ReadingSketch, WeatherReading
+from app.readings import METRICS, insert_ignore
+
+
+SKETCH_K = int(os.getenv('SKETCH_K', 200))
+# Ile par (miasto, dzień) trzymać w pamięci na ścieżce ingest
+SKETCH_CACHE_SIZE = int(os.getenv('SKETCH_CACHE_SIZE', 4096))
+
+DAY = 86400
+_C = 2 / 3  # współczynnik zmniejszania pojemności niższych poziomów
+
+# wersja, k, liczba odczytów, liczba poziomów; dalej rozmiary poziomów i wartości float32
+_HEADER = struct.Struct('<BHQB')
+_VERSION = 1
+
+
+class KLLSketch:
+    """
+    Szkic KLL: poziom h to posortowany bufor wartości o wadze 2**h.
+    Pełny poziom jest kompaktowany - co druga wartość (losowy offset)
+    przechodzi poziom wyżej z podwójną wagą.
+    """
+
+    __slots__ = ('k', 'count', 'levels', '_size', '_capacity')
+
+    def __init__(self, k: int = SKETCH_K):
+        self.k = k
+        self.count = 0
+        self.levels = [[]]
+        self._size = 0
+        self._capacity = self._level_capacity(0)
+
+    def _level_capacity(self, h: int) -> int:
+        depth = len(self.levels) - h - 1
+        return int(math.ceil(self.k * _C ** depth)) + 1
+
+    def _grow(self):
+        self.levels.append([])
+        self._capacity = sum(self._level_capacity(h) for h in range(len(self.levels)))
+
+    def update(self, value: float):
+        self.levels[0].append(value)
+        self.count += 1
+        self._size += 1
+        if self._size >= self._capacity:
+            self._compress()
+
+    def _compress(self):
+        while self._size >= self._capacity:
+            h = 0
+            while h < len(self.levels):
+                level = self.levels[h]
+                if len(level) >= self._level_capacity(h):
+                    if h + 1 == len(self.levels):
+                        self._grow()
+                    level.sort()
+                    # Nieparzysta wartość zostaje na poziomie - suma wag się nie zmienia
+                    keep = [level.pop()] if len(level) % 2 else []
+                    self.levels[h + 1].extend(level[random.getrandbits(1)::2])
+                    self.levels[h] = keep
+                h += 1
+            self._size = sum(len(level) for level in self.levels)
+
+    def merge(self, other: 'KLLSketch'):
+        """Dołącza inny szkic (o tym samym k)"""
+        self._extend(other)
+        self._compress()
+
+    def _extend(self, other: 'KLLSketch'):
+        if other.k != self.k:
+            raise ValueError(f'Cannot merge sketches with k={self.k} and k={other.k}')
+        while len(self.levels) < len(other.levels):
+            self._grow()
+        for h, level in enumerate(other.levels):
+            self.levels[h].extend(level)
+        self.count += other.count
+        self._size += other._size
+
+    @classmethod
+    def merged(cls, sketches, k: int = SKETCH_K) -> 'KLLSketch':
+        """Scala wiele szkiców naraz - jedna kompaktacja na końcu"""
+        result = cls(k)
+        for sketch in sketches:
+            result._extend(sketch)
+        result._compress()
+        return result
+
+    @property
+    def is_exact(self) -> bool:
+        """Bez kompaktacji szkic zawiera wszystkie wartości"""
+        return len(self.levels) == 1
+
+    @property
+    def rank_error(self) -> float:
+        """Przybliżony błąd rangi (ułamek, 99% ufności)"""
+        if self.is_exact:
+            return 0.0
+        return 2.296 / self.k ** 0.9723
+
+    def quantiles(self, qs) -> list:
+        """Wartości dla kwantyli qs (0..1); None dla pustego szkicu"""
+        if not self.count:
+            return [None] * len(qs)
+
+        weighted = sorted(
+            (value, 1 << h) for h, level in enumerate(self.levels) for value in level
+        )
+        cumulative = []
+        total = 0
+        for _, weight in weighted:
+            total += weight
+            cumulative.append(total)
+
+        result = []
+        for q in qs:
+            i = bisect_left(cumulative, q * total)
+            result.append(weighted[min(i, len(weighted) - 1)][0])
+        return result
+
+    def to_bytes(self) -> bytes:
+        sizes = [len(level) for level in self.levels]
+        values = array('f', [value for level in self.levels for value in level])
+        return (_HEADER.pack(_VERSION, self.k, self.count, len(sizes))
+                + struct.pack(f'<{len(sizes)}I', *sizes)
+                + values.tobytes())
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'KLLSketch':
+        version, k, count, depth = _HEADER.unpack_from(data)
+        if version != _VERSION:
+            raise ValueError(f'Unsupported sketch version {version}')
+        sizes = struct.unpack_from(f'<{depth}I', data, _HEADER.size)
+        values = array('f')
+        values.frombytes(data[_HEADER.size + 4 * depth:])
+
+        sketch = cls(k)
+        while len(sketch.levels) < depth:
+            sketch._grow()
+        position = 0
+        for h, size in enumerate(sizes):
+            sketch.levels[h] = values[position:position + size].tolist()
+            position += size
+        sketch.count = count
+        sketch._size = position
+        return sketch
+
+
+def _upsert_statement():
+    """INSERT ... ON CONFLICT (city, metric, day) DO UPDATE zależnie od bazy"""
+    table = ReadingSketch.__table__
+    dialect = db.engine.dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        if dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        statement = dialect_insert(table)
+        return statement.on_conflict_do_update(
+            index_elements=['city', 'metric', 'day'],
+            set_={'count': statement.excluded.count, 'data': statement.excluded.data,
+                  'updated_at': statement.excluded.updated_at}
+        )
+    from sqlalchemy.dialects.mysql import insert as mysql_insert
+    statement = mysql_insert(table)
+    return statement.on_duplicate_key_update(
+        count=statement.inserted.count, data=statement.inserted.data,
+        updated_at=statement.inserted.updated_at
+    )
+
+
+def save_sketches(sketches_by_key):
+    """Zapisuje {(miasto, dzień): {metryka: szkic}} jednym upsertem (executemany)"""
+    now = datetime.utcnow()
+    rows = [
+        {'city': city, 'metric': metric, 'day': day, 'count': sketch.count,
+         'data': sketch.to_bytes(), 'updated_at': now}
+        for (city, day), sketches in sketches_by_key.items()
+        for metric, sketch in sketches.items()
+        if sketch.count
+    ]
+    if rows:
+        db.session.execute(_upsert_statement(), rows)
+    return len(rows)
+
+
+class SketchStore:
+    """
+    Szkice bieżących dni trzymane w pamięci (LRU) i aktualizowane przy ingest;
+    zapis w tej samej transakcji co odczyt.
+
+    Kilka procesów (np. shardy MQTT) może pisać do tych samych szkiców, więc
+    zapis jest warunkowy: UPDATE ... WHERE count = <liczba w szkicu z pamięci>
+    (albo INSERT, gdy wiersza nie było). Gdy inny proces zdążył zmienić szkic,
+    stan jest wczytywany z bazy od nowa i nowe odczyty scalane z nim ponownie -
+    żaden zapis nie nadpisuje cudzych odczytów.
+    """
+
+    def __init__(self, k: int = SKETCH_K, cache_size: int = SKETCH_CACHE_SIZE):
+        self.k = k
+        self.cache_size = cache_size
+        self._cache = OrderedDict()   # (miasto, dzień) -> {metryka: KLLSketch}
+
+    def _sketches(self, city: str, day: int) -> dict:
+        key = (city, day)
+        sketches = self._cache.get(key)
+        if sketches is not None:
+            self._cache.move_to_end(key)
+            return sketches
+        return self._load(city, day)
+
+    def _load(self, city: str, day: int) -> dict:
+        rows = db.session.execute(
+            select(ReadingSketch.metric, ReadingSketch.data)
+            .where(ReadingSketch.city == city, ReadingSketch.day == day)
+        )
+        sketches = {metric: KLLSketch.from_bytes(data) for metric, data in rows}
+        for metric in METRICS:
+            if metric not in sketches:
+                sketches[metric] = KLLSketch(self.k)
+
+        self._cache[(city, day)] = sketches
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return sketches
+
+    def add(self, records) -> int:
+        """Dodaje odczyty do szkiców i zapisuje zmienione szkice (bez commita)"""
+        values = {}   # (miasto, dzień) -> {metryka: [wartości]}
+        for record in records:
+            by_metric = values.setdefault((record.city, record.timestamp // DAY),
+                                          {metric: [] for metric in METRICS})
+            for metric in METRICS:
+                by_metric[metric].append(getattr(record, metric))
+
+        saved = 0
+        for (city, day), by_metric in values.items():
+            pending = dict(by_metric)
+            sketches = self._sketches(city, day)
+            while True:
+                for metric in list(pending):
+                    if self._write(city, day, metric, sketches, pending[metric]):
+                        del pending[metric]
+                        saved += 1
+                if not pending:
+                    break
+                # Inny proces zmienił szkic od naszego odczytu - scal z aktualnym stanem
+                sketches = self._load(city, day)
+        return saved
+
+    def _write(self, city: str, day: int, metric: str, sketches: dict, values) -> bool:
+        """Zapisuje szkic z nowymi wartościami, jeśli w bazie jest ten sam szkic co w pamięci"""
+        base = sketches[metric]
+        sketch = KLLSketch.merged([base], base.k)
+        for value in values:
+            sketch.update(value)
+
+        table = ReadingSketch.__table__
+        row = {'count': sketch.count, 'data': sketch.to_bytes(), 'updated_at': datetime.utcnow()}
+        if base.count:
+            result = db.session.execute(
+                update(table)
+                .where(table.c.city == city, table.c.metric == metric,
+                       table.c.day == day, table.c.count == base.count)
+                .values(**row)
+            )
+        else:
+            result = db.session.execute(
+                insert_ignore(table, ['city', 'metric', 'day']),
+                dict(row, city=city, metric=metric, day=day)
+            )
+        if result.rowcount != 1:
+            return False
+        sketches[metric] = sketch
+        return True
+
+    def reset(self):
+        """Po wycofanej transakcji pamięć mogłaby wyprzedzać bazę - wczytaj od nowa"""
+        self._cache.clear()
+
+
+def rebuild_sketches(keys=None, k: int = SKETCH_K) -> int:
+    """
+    Przelicza szkice z surowych odczytów - dla zbioru (miasto, dzień)
+    albo (keys=None) dla całej historii. Odczyty czytane strumieniowo,
+    dzień po dniu, po indeksie (city, timestamp). Zwraca liczbę zapisanych szkiców.
+    """
+    if keys is None:
+        cities = db.session.execute(select(WeatherReading.city).distinct()).scalars().all()
+        days_by_city = {city: None for city in cities}
+    else:
+        days_by_city = {}
+        for city, day in keys:
+            days_by_city.setdefault(city, set()).add(day)
+
+    columns = [getattr(WeatherReading, metric) for metric in METRICS]
+    saved = 0
+    for city, days in days_by_city.items():
+        query = select(WeatherReading.timestamp, *columns).where(WeatherReading.city == city)
+        if days is not None:
+            query = query.where(WeatherReading.timestamp >= min(days) * DAY,
+                                WeatherReading.timestamp < (max(days) + 1) * DAY)
+        rows = db.session.execute(
+            query.order_by(WeatherReading.timestamp).execution_options(yield_per=10000)
+        )
+
+        current_day = None
+        sketches = None
+        for timestamp, *values in rows:
+            day = timestamp // DAY
+            if day != current_day:
+                if sketches:
+                    saved += save_sketches({(city, current_day): sketches})
+                current_day = day
+                sketches = None
+                if days is None or day in days:
+                    sketches = {metric: KLLSketch(k) for metric in METRICS}
+            if sketches is not None:
+                for metric, value in zip(METRICS, values):
+                    sketches[metric].update(value)
+        if sketches:
+            saved += save_sketches({(city, current_day): sketches})
+        db.session.commit()
+    return saved
+
+
+def merged_sketch(cities, metric: str, start: int = None, end: int = None):
+    """
+    Scala szkice metryki dla miast i zakresu czasu (unix timestamp,
+    zaokrąglany do pełnych dni UTC). Zwraca (szkic, liczba scalonych dni-miast).
+    """
+    query = select(ReadingSketch.data).where(
+        ReadingSketch.city.in_(cities), ReadingSketch.metric == metric
+    )
+    if start is not None:
+        query = query.where(ReadingSketch.day >= start // DAY)
+    if end is not None:
+        query = query.where(ReadingSketch.day <= end // DAY)
+
+    sketches = [KLLSketch.from_bytes(data) for data in db.session.execute(query).scalars()]
+    k = sketches[0].k if sketches else SKETCH_K
+    return KLLSketch.merged(sketches, k), len(sketches)
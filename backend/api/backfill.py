@@ -0,0 +1,343 @@
+"""
+Backfill / Import historycznych odczytów
+Ładuje dane bezpośrednio do weather_readings z pominięciem MQTT:
+strumieniowe czytanie CSV, NDJSON albo zrzutów historii OpenWeather
+i zapis dużymi paczkami (Core insert, executemany) przy zdjętych
+indeksach pomocniczych. Na końcu przeliczane są szkice kwantyli
+dotkniętych dni.
+
+Przykłady (z katalogu backend/api):
+    python backfill.py dane.csv
+    python backfill.py --format ndjson odczyty.ndjson --evaluate-alerts
+    python backfill.py --format owm --city Warszawa history_bulk.json
+    cat dane.csv | python backfill.py --format csv -
+"""
+
+import argparse
+import csv
+import json
+import sys
+import time
+from datetime import datetime
+
+from sqlalchemy import select, text
+
+from app import create_app, db
+from app.alerts import AlertEngine
+from app.models import WeatherReading
+from app.readings import ReadingRecord, insert_readings, update_latest_readings
+from app.sketches import DAY, rebuild_sketches
+
+
+DEFAULT_BATCH_SIZE = 50000
+_READ_CHUNK = 1 << 20
+
+
+# ============ READERS ============
+
+def read_csv(stream, city=None):
+    """Kolumny: city,temperature,humidity,pressure,wind_speed,weather,timestamp (lub dt)"""
+    for row in csv.DictReader(stream):
+        yield ReadingRecord(
+            city or row['city'],
+            float(row['temperature']),
+            int(float(row['humidity'])),
+            int(float(row['pressure'])),
+            float(row['wind_speed']),
+            row.get('weather') or None,
+            int(float(row.get('timestamp') or row['dt']))
+        )
+
+
+def read_ndjson(stream, city=None):
+    """Jeden obiekt JSON na linię - format wiadomości MQTT albo rekord OpenWeather"""
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        item = json.loads(line)
+        if 'main' in item:
+            yield owm_record(item, city)
+        else:
+            if city:
+                item['city'] = city
+            yield ReadingRecord.from_payload(item)
+
+
+def owm_record(item, city=None):
+    """Rekord historii OpenWeather (history bulk / history API) -> ReadingRecord"""
+    main = item['main']
+    weather = item.get('weather') or [{}]
+    return ReadingRecord(
+        city or item.get('city_name') or item['name'],
+        main['temp'],
+        main['humidity'],
+        main['pressure'],
+        item.get('wind', {}).get('speed', 0.0),
+        weather[0].get('description'),
+        item['dt']
+    )
+
+
+def _iter_json_array(stream):
+    """Strumieniowo zwraca elementy tablicy JSON najwyższego poziomu"""
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    started = False
+    eof = False
+
+    while True:
+        # Pomiń białe znaki, przecinki i nawiasy tablicy
+        while position < len(buffer) and buffer[position] in ' \t\r\n,':
+            position += 1
+        if not started and position < len(buffer):
+            if buffer[position] != '[':
+                raise ValueError('Expected a JSON array')
+            started = True
+            position += 1
+            continue
+        if started and position < len(buffer) and buffer[position] == ']':
+            return
+
+        try:
+            if position >= len(buffer):
+                raise ValueError('need more data')
+            item, end = decoder.raw_decode(buffer, position)
+        except ValueError:
+            if eof:
+                if buffer[position:].strip():
+                    raise
+                return
+            chunk = stream.read(_READ_CHUNK)
+            eof = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+
+        position = end
+        yield item
+
+
+def read_owm(stream, city=None):
+    """
+    Zrzut historii OpenWeather: tablica rekordów (history bulk, czytana
+    strumieniowo) albo odpowiedź history API {"list": [...]}
+    """
+    first = stream.read(1)
+    while first and first.isspace():
+        first = stream.read(1)
+
+    if first == '{':
+        data = json.loads(first + stream.read())
+        items = data.get('list', [data])
+    else:
+        items = _iter_json_array(_PrependText(first, stream))
+
+    for item in items:
+        if 'list' in item:
+            for entry in item['list']:
+                yield owm_record(entry, city or item.get('city_name'))
+        else:
+            yield owm_record(item, city)
+
+
+class _PrependText:
+    """Strumień tekstowy z oddanym z powrotem pierwszym znakiem"""
+
+    def __init__(self, prefix, stream):
+        self.prefix = prefix
+        self.stream = stream
+
+    def read(self, size=-1):
+        if self.prefix:
+            prefix, self.prefix = self.prefix, ''
+            return prefix + self.stream.read(size - 1 if size > 0 else -1)
+        return self.stream.read(size)
+
+
+READERS = {
+    'csv': read_csv,
+    'ndjson': read_ndjson,
+    'owm': read_owm,
+}
+
+
+def detect_format(path):
+    lower = path.lower()
+    if lower.endswith('.csv'):
+        return 'csv'
+    if lower.endswith(('.ndjson', '.jsonl')):
+        return 'ndjson'
+    if lower.endswith('.json'):
+        return 'owm'
+    raise ValueError(f"Cannot detect format of '{path}', use --format")
+
+
+# ============ LOADER ============
+
+def _drop_secondary_indexes():
+    """
+    Zdejmuje nieunikalne indeksy weather_readings na czas ładowania;
+    unikalny (city, timestamp) zostaje - na nim opiera się pomijanie duplikatów
+    """
+    dropped = [index for index in WeatherReading.__table__.indexes if not index.unique]
+    with db.engine.begin() as connection:
+        for index in dropped:
+            index.drop(connection, checkfirst=True)
+    return dropped
+
+
+def _restore_indexes(indexes):
+    with db.engine.begin() as connection:
+        for index in indexes:
+            index.create(connection, checkfirst=True)
+
+
+def _prepare_batch_transaction():
+    if db.engine.dialect.name == 'sqlite':
+        # Import można powtórzyć, więc pełna trwałość każdej paczki nie jest potrzebna
+        db.session.execute(text('PRAGMA synchronous = OFF'))
+
+
+def _new_records(batch):
+    """Odczyty paczki, których jeszcze nie ma w bazie (ani wcześniej w paczce)"""
+    fresh = {}
+    for record in batch:
+        fresh.setdefault((record.city, record.timestamp), record)
+
+    cities = {record.city for record in batch}
+    existing = db.session.execute(
+        select(WeatherReading.city, WeatherReading.timestamp).where(
+            WeatherReading.city.in_(cities),
+            WeatherReading.timestamp.between(min(r.timestamp for r in batch),
+                                             max(r.timestamp for r in batch))
+        )
+    )
+    for key in existing:
+        fresh.pop(tuple(key), None)
+    return list(fresh.values())
+
+
+def _load_batch(batch, engine):
+    _prepare_batch_transaction()
+    if engine is not None:
+        # Ocenić trzeba dokładnie te odczyty, które zostaną dodane
+        batch = _new_records(batch)
+    inserted = insert_readings(batch, commit=False, update_latest=False)
+
+    alerts = 0
+    if engine is not None:
+        # Ocena w kolejności czasu, z czasem odczytu jako "teraz" epizodu;
+        # epizody zapisywane raz na paczkę, w jednej transakcji z odczytami
+        for record in sorted(batch, key=lambda r: r.timestamp):
+            alerts += len(engine.check_reading(
+                record, now=datetime.utcfromtimestamp(record.timestamp), commit=False))
+        engine.flush_episodes()
+    db.session.commit()
+    return inserted, alerts
+
+
+def backfill(records, batch_size=DEFAULT_BATCH_SIZE, evaluate_alerts=False,
+             defer_indexes=True):
+    """
+    Ładuje odczyty paczkami; zwraca (liczba dodanych odczytów, liczba nowych alertów).
+    Odczyty już obecne w bazie (city, timestamp) są pomijane, więc import można powtórzyć.
+    """
+    # Epizody importu prowadzone osobno - trwające epizody z bazy zostają nietknięte
+    engine = AlertEngine(live=False) if evaluate_alerts else None
+    deferred = _drop_secondary_indexes() if defer_indexes else []
+
+    total = loaded = alerts = 0
+    cities = set()
+    touched = set()               # (miasto, dzień) do przeliczenia szkiców kwantyli
+    started = time.perf_counter()
+    batch = []
+    try:
+        for record in records:
+            batch.append(record)
+            if len(batch) >= batch_size:
+                inserted, generated = _load_batch(batch, engine)
+                total += len(batch)
+                loaded += inserted
+                alerts += generated
+                cities.update(r.city for r in batch)
+                if inserted:
+                    touched.update((r.city, r.timestamp // DAY) for r in batch)
+                batch = []
+                elapsed = time.perf_counter() - started
+                print(f"   {total:>12,} rows | {total / elapsed * 60:>12,.0f} rows/min")
+        if batch:
+            inserted, generated = _load_batch(batch, engine)
+            total += len(batch)
+            loaded += inserted
+            alerts += generated
+            cities.update(r.city for r in batch)
+            if inserted:
+                touched.update((r.city, r.timestamp // DAY) for r in batch)
+    finally:
+        if deferred:
+            print("Rebuilding indexes...")
+            _restore_indexes(deferred)
+
+    # Rollupy: najnowszy odczyt każdego dotkniętego miasta
+    if engine is not None:
+        # Epizody otwarte na końcu historii kończą się na ostatnim odczycie -
+        # bieżący stan należy do subskrybenta MQTT
+        engine.close_open_episodes()
+    if total > loaded:
+        print(f"   skipped {total - loaded:,} duplicate row(s)")
+    update_latest_readings(cities)
+    db.session.commit()
+
+    # Szkice przeliczane z bazy - poprawne także gdy część paczki była duplikatami
+    if touched:
+        print(f"Building quantile sketches for {len(touched):,} city-day(s)...")
+        rebuild_sketches(touched)
+    return loaded, alerts
+
+
+def _open_input(path):
+    if path == '-':
+        return sys.stdin
+    return open(path, encoding='utf-8-sig', newline='')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Bulk import historycznych odczytów pogodowych')
+    parser.add_argument('paths', nargs='+', help="pliki wejściowe ('-' = stdin)")
+    parser.add_argument('--format', choices=sorted(READERS), help='format wejścia (domyślnie po rozszerzeniu)')
+    parser.add_argument('--city', help='nazwa miasta dla danych bez pola city')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--evaluate-alerts', action='store_true',
+                        help='przepuść odczyty przez reguły alertów (wolniej)')
+    parser.add_argument('--keep-indexes', action='store_true',
+                        help='nie zdejmuj indeksów na czas importu')
+    args = parser.parse_args(argv)
+
+    app = create_app()
+    with app.app_context():
+        started = time.perf_counter()
+        total = alerts = 0
+        for path in args.paths:
+            fmt = args.format or detect_format(path)
+            print(f"📥 Loading {path} ({fmt})...")
+            with _open_input(path) as stream:
+                loaded, generated = backfill(
+                    READERS[fmt](stream, args.city),
+                    batch_size=args.batch_size,
+                    evaluate_alerts=args.evaluate_alerts,
+                    defer_indexes=not args.keep_indexes
+                )
+            total += loaded
+            alerts += generated
+
+        elapsed = time.perf_counter() - started
+        print(f"\n✓ Loaded {total:,} readings in {elapsed:.1f}s "
+              f"({total / max(elapsed, 1e-9) * 60:,.0f} rows/min)")
+        if args.evaluate_alerts:
+            print(f"✓ Opened {alerts} alert episode(s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+Benchmark odpowiedzi historii
+Porównuje dotychczasowy format (lista słowników z to_dict() + jsonify)
+z formatem kolumnowym (+ gzip/brotli): rozmiar odpowiedzi i czas serializacji.
+
+Uruchomienie (z katalogu backend/api):
+    python bench_history.py [liczba_odczytów]
+"""
+
+import os
+import sys
+import time
+
+# Benchmark działa na bazie w pamięci, żeby nie ruszać weather.db
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from app import create_app
+from app.encoding import brotli, orjson
+from app.readings import ReadingRecord, insert_readings
+
+
+def measure(client, query, headers=None, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        response = client.get(f'/api/weather/history?{query}', headers=headers or {})
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(response.data), best
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    app = create_app()
+    with app.app_context():
+        weathers = ['clear sky', 'few clouds', 'light rain', 'overcast clouds']
+        insert_readings([
+            ReadingRecord('Warszawa', 270 + (i % 300) / 10, 40 + i % 50, 990 + i % 40,
+                          (i % 170) / 10, weathers[i % 4], 1700000000 + 600 * i)
+            for i in range(count)
+        ])
+
+    client = app.test_client()
+    base = f'city=Warszawa&limit={count}'
+
+    print(f"Historia {count} odczytów (orjson: {'tak' if orjson else 'nie'}, "
+          f"brotli: {'tak' if brotli else 'nie'})\n")
+
+    cases = [
+        ('wiersze (obecnie)', base, None),
+        ('kolumnowy', f'{base}&format=columnar', None),
+        ('kolumnowy + gzip', f'{base}&format=columnar', {'Accept-Encoding': 'gzip'}),
+    ]
+    if brotli is not None:
+        cases.append(('kolumnowy + br', f'{base}&format=columnar', {'Accept-Encoding': 'br'}))
+
+    baseline_size = baseline_time = None
+    for name, query, headers in cases:
+        size, elapsed = measure(client, query, headers)
+        if baseline_size is None:
+            baseline_size, baseline_time = size, elapsed
+        print(f"{name:>20}: {size / 1024:9.1f} KiB ({size / baseline_size:6.1%}) | "
+              f"{elapsed * 1000:7.1f} ms ({baseline_time / elapsed:4.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
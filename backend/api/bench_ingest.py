@@ -0,0 +1,109 @@
+"""
+Benchmark ścieżki ingest
+Porównuje zapis odczytu przez obiekt ORM (WeatherReading + session.add)
+z lekkim ReadingRecord + Core insert: czas na wiadomość oraz alokacje.
+
+Uruchomienie (z katalogu backend/api):
+    python bench_ingest.py [liczba_wiadomości]
+"""
+
+import os
+import sys
+import time
+import tracemalloc
+
+# Benchmark działa na bazie w pamięci, żeby nie ruszać weather.db
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from app import create_app, db
+from app.models import WeatherReading
+from app.readings import ReadingRecord, insert_readings, METRICS
+
+
+PAYLOAD = {
+    'city': 'Warszawa',
+    'temperature': 281.4,
+    'humidity': 71,
+    'pressure': 1013,
+    'wind_speed': 4.6,
+    'weather': 'light rain',
+    'timestamp': 1700000000
+}
+
+
+def ingest_orm(payload):
+    """Dotychczasowa ścieżka: pełny obiekt ORM i unit-of-work"""
+    reading = WeatherReading(
+        city=payload['city'],
+        temperature=payload['temperature'],
+        humidity=payload['humidity'],
+        pressure=payload['pressure'],
+        wind_speed=payload['wind_speed'],
+        weather=payload['weather'],
+        timestamp=payload['timestamp']
+    )
+    db.session.add(reading)
+    db.session.commit()
+    # odczyt wartości tak jak robił to AlertEngine (słownik na każdą regułę)
+    for metric in METRICS:
+        {
+            'temperature': reading.temperature,
+            'humidity': reading.humidity,
+            'pressure': reading.pressure,
+            'wind_speed': reading.wind_speed
+        }.get(metric)
+    return reading
+
+
+def ingest_record(payload):
+    """Nowa ścieżka: ReadingRecord i Core insert"""
+    reading = ReadingRecord.from_payload(payload)
+    insert_readings([reading])
+    for metric in METRICS:
+        getattr(reading, metric)
+    return reading
+
+
+def measure(name, func, count):
+    # Osobne miasto i znaczniki czasu dla każdego pomiaru - odczyty są unikalne po (city, timestamp)
+    payloads = [dict(PAYLOAD, city=f"{PAYLOAD['city']}-{name}", timestamp=PAYLOAD['timestamp'] + i)
+                for i in range(count + 1000)]
+
+    start = time.perf_counter()
+    for payload in payloads[:count]:
+        func(payload)
+    elapsed = time.perf_counter() - start
+
+    # Alokacje: ile bloków i bajtów zajmują obiekty trzymane po ingest
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    kept = [func(payload) for payload in payloads[count:]]
+    after = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    stats = after.compare_to(before, 'filename')
+    blocks = sum(stat.count_diff for stat in stats)
+    size = sum(stat.size_diff for stat in stats)
+
+    print(f"{name:>8}: {elapsed / count * 1e6:8.1f} µs/msg | "
+          f"{blocks / len(kept):6.1f} bloków/msg | "
+          f"{size / len(kept):8.1f} B/msg zatrzymane | "
+          f"peak {peak / 1024:8.1f} KiB")
+    return elapsed / count
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+
+    app = create_app()
+    with app.app_context():
+        print(f"Ingest {count} wiadomości (sqlite w pamięci)\n")
+        orm_time = measure('ORM', ingest_orm, count)
+        db.session.expunge_all()
+        record_time = measure('record', ingest_record, count)
+        print(f"\nPrzyspieszenie: {orm_time / record_time:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -2,9 +2,9 @@
 Initialize Default Alert Rules
 """
 
-from app import create_app, db
-from app.models import AlertRule
-from app.alerts import DEFAULT_ALERT_RULES
+from app import create_app
+from app.alerts import DEFAULT_ALERT_RULES, seed_default_rules
+from app.cities import active_city_names, ensure_default_cities
 
 
 def init_default_rules():
@@ -13,42 +13,21 @@ def init_default_rules():
     app = create_app()
     
     with app.app_context():
-        # Pobierz wszystkie monitorowane miasta z collector
-        cities = ["Warszawa", "Yakutsk"]  # Można rozszerzyć
+        # Miasta z rejestru (pusty rejestr dostaje miasta domyślne)
+        if ensure_default_cities():
+            print("📍 City registry was empty - added default cities")
+        cities = active_city_names()
         
-        print("🔧 Initializing default alert rules...")
+        print(f"🔧 Initializing default alert rules for {len(cities)} cities...")
         
-        for city in cities:
-            print(f"\n Creating rules for {city}:")
-            
-            for rule_template in DEFAULT_ALERT_RULES:
-                # Sprawdź czy reguła już istnieje
-                existing = AlertRule.query.filter_by(
-                    city=city,
-                    name=rule_template['name'],
-                    condition_type=rule_template['condition_type']
-                ).first()
-                
-                if existing:
-                    print(f"   ⏭  Skipping '{rule_template['name']}' - already exists")
-                    continue
-                
-                # Utwórz nową regułę
-                rule = AlertRule(
-                    name=rule_template['name'],
-                    city=city,
-                    condition_type=rule_template['condition_type'],
-                    operator=rule_template['operator'],
-                    threshold=rule_template['threshold'],
-                    is_active=True
-                )
-                
-                db.session.add(rule)
-                print(f"   ✓ Created: {rule_template['name']}")
+        # Jedno zapytanie o istniejące reguły i jeden zbiorczy insert
+        created = seed_default_rules(cities)
+        skipped = len(cities) * len(DEFAULT_ALERT_RULES) - created
         
-        db.session.commit()
+        print(f"   ✓ Created: {created}")
+        print(f"   ⏭  Skipped (already exist): {skipped}")
         print("\n All default alert rules initialized!")
 
 
 if __name__ == '__main__':
-    init_default_rules()
\ No newline at end of file
+    init_default_rules()
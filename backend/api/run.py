@@ -1,10 +1,10 @@
-from app import create_app
-from app.mqtt_subscriber import MQTTSubscriber
+import os
 import signal
 import sys
+import threading
 
 
-app = create_app()
+app = None
 subscriber = None
 
 
@@ -18,13 +18,56 @@ def signal_handler(sig, frame):
     sys.exit(0)
 
 
+def profile_signal_handler(sig, frame):
+    """SIGUSR1 - profiluje następne PROFILE_SIGNAL_COUNT wiadomości MQTT"""
+    count = int(os.getenv('PROFILE_SIGNAL_COUNT', 100))
+    mode = os.getenv('PROFILE_SIGNAL_MODE', 'cprofile')
+    try:
+        app.extensions['profiler'].profile_ingest(count, mode)
+    except (ValueError, RuntimeError) as e:
+        print(f"Profiling not started: {e}")
 
 
-if __name__ == '__main__':
-    signal.signal(signal.SIGINT, signal_handler)
+def start_background_services(app):
+    """
+    Schemat, domyślne reguły i MQTT przygotowywane w tle,
+    serwer HTTP przyjmuje połączenia od razu (/api/health/ready mówi kiedy gotowe)
+    """
+    global subscriber
+
+    from app import prepare_schema
+    prepare_schema(app)
+
+    if os.getenv('SEED_DEFAULT_RULES', 'false').lower() == 'true':
+        from app.alerts import seed_default_rules
+        from app.cities import active_city_names, ensure_default_cities
+        with app.app_context():
+            ensure_default_cities()
+            created = seed_default_rules(active_city_names())
+        print(f"Seeded {created} default alert rule(s)")
 
+    # paho importowany dopiero tutaj, poza ścieżką startu serwera
+    from app.mqtt_subscriber import MQTTSubscriber
     subscriber = MQTTSubscriber(app)
+    with app.app_context():
+        subscriber.anomaly_detector.bootstrap()
     subscriber.connect()
 
 
-    app.run(host='0.0.0.0', port=5000, debug=False)
\ No newline at end of file
+
+
+if __name__ == '__main__':
+    signal.signal(signal.SIGINT, signal_handler)
+
+    from app import create_app
+    app = create_app(init_schema=False)
+    app.extensions['mqtt_subscriber'] = None  # gotowość czeka na MQTT
+
+    if hasattr(signal, 'SIGUSR1'):  # brak na Windows
+        signal.signal(signal.SIGUSR1, profile_signal_handler)
+
+    threading.Thread(target=start_background_services, args=(app,),
+                     name='startup', daemon=True).start()
+
+
+    app.run(host='0.0.0.0', port=5000, debug=False)
@@ -0,0 +1,65 @@
+"""
+Indeks siatkowy miast - porównanie z przeszukaniem wszystkich punktów
+(uruchomienie z katalogu backend/api: python -m pytest tests)
+"""
+
+import random
+
+import pytest
+
+from app.geo import GridIndex, haversine_km
+
+
+@pytest.fixture(scope='module')
+def points():
+    rng = random.Random(42)
+    return [(f'city{i}', rng.uniform(-90, 90), rng.uniform(-180, 180)) for i in range(10000)]
+
+
+@pytest.fixture(scope='module')
+def index(points):
+    return GridIndex(points)
+
+
+def brute_bbox(points, min_lat, min_lon, max_lat, max_lon):
+    crosses = min_lon > max_lon
+    return {
+        name for name, lat, lon in points
+        if min_lat <= lat <= max_lat
+        and ((lon >= min_lon or lon <= max_lon) if crosses else min_lon <= lon <= max_lon)
+    }
+
+
+@pytest.mark.parametrize('bbox', [
+    (49, 14, 55, 24),
+    (-90, 10.5, 90, 10.2),        # przez 180°, oba końce w tej samej kolumnie
+    (-10, 170, 10, -170),         # przez 180°
+    (60, 179.5, 90, -179.5),
+    (-90, -180, 90, 180),
+    (0, 0.1, 0.5, 0.2),
+])
+def test_within_bbox_matches_brute_force(points, index, bbox):
+    assert set(index.within_bbox(*bbox)) == brute_bbox(points, *bbox)
+
+
+def test_within_bbox_random(points, index):
+    rng = random.Random(7)
+    for _ in range(200):
+        min_lat, max_lat = sorted(rng.uniform(-90, 90) for _ in range(2))
+        min_lon, max_lon = rng.uniform(-180, 180), rng.uniform(-180, 180)
+        bbox = (min_lat, min_lon, max_lat, max_lon)
+        assert set(index.within_bbox(*bbox)) == brute_bbox(points, *bbox)
+
+
+def test_within_radius_matches_brute_force(points, index):
+    rng = random.Random(11)
+    centers = [(0, 179.9, 500), (89.5, 0, 300), (-89, 45, 1000), (52.2, 21.0, 100)]
+    centers += [(rng.uniform(-90, 90), rng.uniform(-180, 180), rng.uniform(10, 3000))
+                for _ in range(100)]
+    for lat, lon, radius in centers:
+        expected = {name for name, p_lat, p_lon in points
+                    if haversine_km(lat, lon, p_lat, p_lon) <= radius}
+        result = index.within_radius(lat, lon, radius)
+        assert {name for name, _ in result} == expected
+        distances = [distance for _, distance in result]
+        assert distances == sorted(distances)
@@ -0,0 +1,127 @@
+"""
+Szkice kwantyli KLL - błąd rangi względem posortowanych danych,
+serializacja i scalanie
+(uruchomienie z katalogu backend/api: python -m pytest tests)
+"""
+
+import math
+import random
+from bisect import bisect_left, bisect_right
+
+import pytest
+
+from app.sketches import KLLSketch
+
+QS = [0.01, 0.05, 0.1, 0.25, 0.5, 0.75, 0.9, 0.95, 0.99]
+
+
+@pytest.fixture(autouse=True)
+def seeded_random():
+    # Kompaktacja wybiera losowy offset - powtarzalne wyniki testów
+    random.seed(1234)
+
+
+def sketch_of(values, k=200):
+    sketch = KLLSketch(k)
+    for value in values:
+        sketch.update(value)
+    return sketch
+
+
+def assert_rank_error(sketch, data):
+    """Ranga każdego zwróconego kwantyla mieści się w deklarowanym błędzie"""
+    data = sorted(data)
+    n = len(data)
+    for q, value in zip(QS, sketch.quantiles(QS)):
+        # Przy powtórzonych wartościach dowolna ranga z przedziału jest poprawna
+        low, high = bisect_left(data, value) / n, bisect_right(data, value) / n
+        error = max(low - q, q - high, 0)
+        assert error <= sketch.rank_error, (q, value, error)
+
+
+def test_exact_until_compacted():
+    data = [random.uniform(-30, 40) for _ in range(150)]
+    sketch = sketch_of(data)
+    assert sketch.is_exact
+    assert sketch.rank_error == 0.0
+    expected = sorted(data)
+    assert sketch.quantiles(QS) == [expected[max(math.ceil(q * len(data)) - 1, 0)] for q in QS]
+
+
+@pytest.mark.parametrize('order', ['shuffled', 'ascending', 'descending'])
+def test_rank_error_against_sorted_data(order):
+    data = [random.gauss(10, 8) for _ in range(100000)]
+    if order == 'ascending':
+        data.sort()
+    elif order == 'descending':
+        data.sort(reverse=True)
+    sketch = sketch_of(data)
+    assert not sketch.is_exact
+    assert sketch.count == len(data)
+    assert sum(len(level) << h for h, level in enumerate(sketch.levels)) == len(data)
+    assert sum(len(level) for level in sketch.levels) < 3 * sketch.k
+    assert_rank_error(sketch, data)
+
+
+def test_empty_sketch():
+    sketch = KLLSketch()
+    assert sketch.quantiles([0.5, 0.9]) == [None, None]
+    assert KLLSketch.from_bytes(sketch.to_bytes()).count == 0
+
+
+def test_bytes_round_trip():
+    # Wartości zapisywane jako float32 - dane dokładnie reprezentowalne
+    data = [random.randint(-400, 400) / 4 for _ in range(20000)]
+    sketch = sketch_of(data, k=64)
+    restored = KLLSketch.from_bytes(sketch.to_bytes())
+
+    assert restored.k == sketch.k
+    assert restored.count == sketch.count
+    assert restored.levels == sketch.levels
+    assert restored.quantiles(QS) == sketch.quantiles(QS)
+    assert restored.to_bytes() == sketch.to_bytes()
+
+    # Odtworzony szkic dalej przyjmuje wartości jak oryginał
+    more = [random.randint(-400, 400) / 4 for _ in range(5000)]
+    for value in more:
+        restored.update(value)
+    assert restored.count == len(data) + len(more)
+    assert_rank_error(restored, data + more)
+
+
+def test_from_bytes_rejects_unknown_version():
+    data = bytearray(sketch_of([1.0, 2.0]).to_bytes())
+    data[0] = 99
+    with pytest.raises(ValueError):
+        KLLSketch.from_bytes(bytes(data))
+
+
+def test_merge_matches_whole_stream():
+    data = [random.gauss(1013, 9) for _ in range(60000)]
+    parts = [data[i::7] for i in range(7)]
+    sketches = [sketch_of(part) for part in parts]
+
+    merged = KLLSketch.merged(sketches)
+    assert merged.count == len(data)
+    assert_rank_error(merged, data)
+
+    sequential = KLLSketch()
+    for sketch in sketches:
+        sequential.merge(sketch)
+    assert sequential.count == len(data)
+    assert_rank_error(sequential, data)
+
+
+def test_merge_of_serialized_day_sketches():
+    # Jak /weather/percentiles: dzienne szkice z bazy scalane w zakres
+    days = [[random.uniform(day, day + 20) for _ in range(2000)] for day in range(30)]
+    blobs = [sketch_of(values).to_bytes() for values in days]
+
+    merged = KLLSketch.merged(KLLSketch.from_bytes(blob) for blob in blobs)
+    assert merged.count == sum(len(values) for values in days)
+    assert_rank_error(merged, [value for values in days for value in values])
+
+
+def test_merge_rejects_different_k():
+    with pytest.raises(ValueError):
+        KLLSketch(100).merge(KLLSketch(200))
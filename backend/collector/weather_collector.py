@@ -6,12 +6,45 @@ and publishes to MQTT broker
 from dotenv import load_dotenv
 import paho.mqtt.client as mqtt
 import requests
+import heapq
 import json
 import os
+import random
 import time
 
 load_dotenv()
 
+# Granice i parametry harmonogramu odpytywania (sekundy)
+POLL_MIN_INTERVAL = float(os.getenv("POLL_MIN_INTERVAL", 30))
+POLL_MAX_INTERVAL = float(os.getenv("POLL_MAX_INTERVAL", 900))
+POLL_DEFAULT_INTERVAL = float(os.getenv("POLL_DEFAULT_INTERVAL", 120))
+POLL_JITTER = float(os.getenv("POLL_JITTER", 0.1))
+
+# Skąd brać rejestr miast i reguły alertów (żeby częściej odpytywać miasta blisko progu)
+WEATHER_API_URL = os.getenv("WEATHER_API_URL", "http://localhost:5000/api")
+RULES_REFRESH_INTERVAL = 300
+CITIES_REFRESH_INTERVAL = float(os.getenv("CITIES_REFRESH_INTERVAL", 60))
+
+# Zmiana między kolejnymi odczytami uznawana za "szybką"
+FAST_CHANGE = {"temperature": 1.0, "humidity": 5, "pressure": 2, "wind_speed": 2.0}
+# Odległość od progu reguły uznawana za "blisko progu"
+NEAR_THRESHOLD = {"temperature": 1.5, "humidity": 5, "pressure": 3, "wind_speed": 2.0}
+
+
+class CitySchedule:
+    """Stan harmonogramu jednego miasta"""
+
+    __slots__ = ("name", "interval", "due", "last_dt", "cadence", "last_values")
+
+    def __init__(self, name, interval=POLL_DEFAULT_INTERVAL):
+        self.name = name
+        self.interval = interval
+        self.due = None           # aktualny termin w kolejce
+        self.last_dt = None       # ostatni znacznik "dt" z OpenWeather
+        self.cadence = None       # zaobserwowany okres odświeżania danych
+        self.last_values = None
+
+
 
 class WeatherCollector:
     """Collects whater data and publishes to MQTT"""
@@ -24,7 +57,7 @@ class WeatherCollector:
 
         self.base_url  = "https://api.openweathermap.org/data/2.5/weather?q={city_name}&appid={api_key}"
     
-        # Cities to monitor
+        # Cities to monitor (domyślne, dopóki nie wczytamy rejestru z API)
         self.cities = [
             {"name": "Warszawa", "lat": 52.15, "lon": 21},
             {"name": "Yakutsk", "lat": 62.03, "lon": 129.73}
@@ -36,14 +69,29 @@ class WeatherCollector:
         self.mqtt_username = os.getenv("MQTT_USERNAME")
         self.mqtt_password = os.getenv("MQTT_PASSWORD")    
 
+        # QoS 1: broker potwierdza każdą wiadomość, niepotwierdzone paho wysyła ponownie;
+        # publikacje przy zerwanym połączeniu czekają w kolejce (do MQTT_MAX_QUEUED)
+        self.mqtt_qos = int(os.getenv("MQTT_QOS", 1))
+        self.mqtt_max_inflight = int(os.getenv("MQTT_MAX_INFLIGHT", 100))
+        self.mqtt_max_queued = int(os.getenv("MQTT_MAX_QUEUED", 10000))
+
         self.use_mqtt = use_mqtt
         self.mqtt_connected = False  
 
+        # Harmonogram: kopiec (następny termin, miasto)
+        self.schedule = {}
+        self.due_queue = []
+        self.alert_thresholds = {}
+        self.rules_loaded_at = 0
+        self.cities_loaded_at = 0
+
         if self.use_mqtt:
             import uuid
-            unique_client_id = f"wheater_collector_{uuid.uuid4().hex[:8]}"
+            unique_client_id = os.getenv("MQTT_CLIENT_ID") or f"wheater_collector_{uuid.uuid4().hex[:8]}"
             self.mqtt_client = mqtt.Client(client_id=unique_client_id,
                                         callback_api_version=mqtt.CallbackAPIVersion.VERSION2)
+            self.mqtt_client.max_inflight_messages_set(self.mqtt_max_inflight)
+            self.mqtt_client.max_queued_messages_set(self.mqtt_max_queued)
             self.mqtt_client.on_connect = self._on_connect
             self.mqtt_client.on_disconnect = self._on_disconnect
             print(f"Using MQTT client_id: {unique_client_id}")
@@ -80,7 +128,7 @@ class WeatherCollector:
             if self.mqtt_connected:
                 if subscribe:
                     print("Subscribing to weather/# (receiving message)...")
-                    self.mqtt_client.subscribe("weather/#")
+                    self.mqtt_client.subscribe("weather/#", qos=self.mqtt_qos)
                 return True
             time.sleep(2)
 
@@ -122,12 +170,181 @@ class WeatherCollector:
         topic = f"weather/{city_name.lower()}"
         payload = json.dumps(data, ensure_ascii=False)
 
-        if self.mqtt_connected:
-            self.mqtt_client.publish(topic, payload)
-            print(f"Published weather data for {city_name} to topic: {topic}")
+        # Przy QoS > 0 paho kolejkuje wiadomość i wyśle ją po ponownym połączeniu
+        if self.mqtt_connected or self.mqtt_qos > 0:
+            self.mqtt_client.publish(topic, payload, qos=self.mqtt_qos)
+            if self.mqtt_connected:
+                print(f"Published weather data for {city_name} to topic: {topic}")
+            else:
+                print(f"MQTT not connected — queued weather data for {city_name}")
         else:
             print("Cannot publish — MQTT not connected")
 
+        return data
+
+    def load_alert_thresholds(self):
+        """Pobiera progi aktywnych reguł z API (miasto -> [(metryka, próg)])"""
+        try:
+            response = requests.get(f"{WEATHER_API_URL}/alert-rules",
+                                    params={"active_only": "true"}, timeout=5)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            print(f"Could not load alert rules: {e}")
+            return
+
+        thresholds = {}
+        for rule in response.json():
+            # Reguły anomalii mają próg w odchyleniach standardowych (z-score),
+            # nie w jednostkach metryki - nie da się ich porównać z odczytem
+            if rule["operator"] == "anomaly":
+                continue
+            thresholds.setdefault(rule["city"], []).append(
+                (rule["condition_type"], rule["threshold"]))
+        self.alert_thresholds = thresholds
+        self.rules_loaded_at = time.monotonic()
+
+    def _near_threshold(self, city_name, data):
+        """Czy któraś wartość jest blisko progu reguły alertu"""
+        for condition_type, threshold in self.alert_thresholds.get(city_name, ()):
+            value = data.get(condition_type)
+            if value is None or condition_type not in NEAR_THRESHOLD:
+                continue
+            if condition_type == "temperature":
+                value = value - 273.15
+            if abs(value - threshold) <= NEAR_THRESHOLD[condition_type]:
+                return True
+        return False
+
+    def _changing_fast(self, previous, data):
+        """Czy wartości zmieniły się mocno od poprzedniego odczytu"""
+        if previous is None:
+            return False
+        return any(abs(data[key] - previous[key]) >= limit
+                   for key, limit in FAST_CHANGE.items())
+
+    def _next_interval(self, state, data):
+        """Wylicza nowy interwał miasta na podstawie odczytu"""
+        dt = data["timestamp"]
+        interval = state.interval
+
+        if state.last_dt is None:
+            interval = POLL_DEFAULT_INTERVAL
+        elif dt == state.last_dt:
+            # Dane jeszcze nie odświeżone po stronie OpenWeather - zwolnij
+            interval = interval * 1.5
+        else:
+            # Nowe dane: ucz się okresu odświeżania (średnia wykładnicza)
+            period = dt - state.last_dt
+            state.cadence = period if state.cadence is None else 0.7 * state.cadence + 0.3 * period
+            # Odpytuj w połowie okresu, żeby nie przegapić aktualizacji
+            interval = state.cadence / 2
+
+            if self._changing_fast(state.last_values, data):
+                interval = interval / 2
+            state.last_values = data
+
+        if dt != state.last_dt:
+            state.last_dt = dt
+
+        if self._near_threshold(state.name, data):
+            interval = min(interval, POLL_MIN_INTERVAL * 2)
+
+        return max(POLL_MIN_INTERVAL, min(POLL_MAX_INTERVAL, interval))
+
+    def _schedule(self, state, delay):
+        """Wstawia miasto do kolejki z losowym rozrzutem terminu"""
+        jitter = delay * random.uniform(-POLL_JITTER, POLL_JITTER)
+        state.due = time.monotonic() + delay + jitter
+        heapq.heappush(self.due_queue, (state.due, state.name))
+
+    def load_cities(self):
+        """
+        Pobiera aktywne miasta z rejestru API. Przy błędzie albo pustym
+        rejestrze (niezainicjalizowana baza) zostaje obecna lista.
+        """
+        self.cities_loaded_at = time.monotonic()
+        try:
+            response = requests.get(f"{WEATHER_API_URL}/cities", timeout=5)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            print(f"Could not load city registry: {e}")
+            return False
+
+        registry = response.json()
+        if not registry:
+            print("City registry is empty, keeping current cities")
+            return False
+
+        cities = [{"name": c["name"], "lat": c["lat"], "lon": c["lon"]}
+                  for c in registry if c.get("is_active", True)]
+        changed = {c["name"] for c in cities} != {c["name"] for c in self.cities}
+        self.cities = cities
+        return changed
+
+    def sync_schedule(self):
+        """
+        Dopasowuje harmonogram do listy miast bez restartu: nowe miasta
+        dostają losowy pierwszy termin, usunięte znikają z kolejki
+        (ich wpisy w kopcu są pomijane przy zdjęciu)
+        """
+        names = {city["name"] for city in self.cities}
+
+        for name in list(self.schedule):
+            if name not in names:
+                del self.schedule[name]
+                print(f"Stopped polling {name}")
+
+        for name in names - set(self.schedule):
+            state = self.schedule[name] = CitySchedule(name)
+            state.due = time.monotonic() + random.uniform(0, POLL_MIN_INTERVAL)
+            heapq.heappush(self.due_queue, (state.due, state.name))
+            print(f"Started polling {name}")
+
+    def start_schedule(self):
+        """Rozkłada pierwsze zapytania równomiernie zamiast wszystkich naraz"""
+        self.schedule = {}
+        self.due_queue = []
+        self.sync_schedule()
+
+    def run_scheduler(self):
+        """Główna pętla: odpytuje miasto, którego termin mija najwcześniej"""
+        self.load_cities()
+        self.load_alert_thresholds()
+        self.start_schedule()
+
+        while True:
+            now = time.monotonic()
+            if now - self.cities_loaded_at > CITIES_REFRESH_INTERVAL:
+                if self.load_cities():
+                    self.sync_schedule()
+            if now - self.rules_loaded_at > RULES_REFRESH_INTERVAL:
+                self.load_alert_thresholds()
+
+            # Nie śpij dłużej niż do następnego odświeżenia rejestru
+            next_refresh = self.cities_loaded_at + CITIES_REFRESH_INTERVAL
+            if not self.due_queue or self.due_queue[0][0] > next_refresh:
+                time.sleep(max(0, next_refresh - time.monotonic()))
+                continue
+
+            due, city_name = self.due_queue[0]
+            wait = due - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            heapq.heappop(self.due_queue)
+
+            state = self.schedule.get(city_name)
+            if state is None or state.due != due:
+                continue  # miasto usunięte z rejestru albo nieaktualny wpis
+
+            try:
+                data = self.publish_weather(city_name)
+                state.interval = self._next_interval(state, data)
+            except (ConnectionError, ValueError, requests.RequestException) as e:
+                print(f"Failed to poll {city_name}: {e}")
+                state.interval = min(POLL_MAX_INTERVAL, state.interval * 2)
+
+            print(f"Next poll for {city_name} in ~{state.interval:.0f}s")
+            self._schedule(state, state.interval)
 
 
 
@@ -135,13 +352,8 @@ if __name__ == "__main__":
     collector = WeatherCollector()
     print(f"API KEY loaded: {collector.api_key[:8]}...")
     collector.connect_mqtt()
-    weather_data = collector.fetch_weather("Warszawa")
     try:
-        while True:
-            collector.publish_weather("Warszawa")
-            collector.publish_weather("Yakutsk")
-            time.sleep(10)
-            print(json.dumps(weather_data, indent=4, ensure_ascii=False))
+        collector.run_scheduler()
     except KeyboardInterrupt:
         collector.mqtt_client.loop_stop()
         collector.mqtt_client.disconnect()